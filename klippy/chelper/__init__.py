@@ -3,9 +3,12 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, logging, hashlib, imp, shutil, tempfile, time, traceback
 import cffi
 
+class error(Exception):
+    pass
+
 
 ######################################################################
 # c_helper.so compiling
@@ -19,9 +22,19 @@ SOURCE_FILES = [
     'kin_cartesian.c', 'kin_corexy.c', 'kin_delta.c', 'kin_extruder.c'
 ]
 DEST_LIB = "c_helper.so"
+BUILD_CACHE_DIR = "build-cache"
+BUILD_CACHE_SIZE = 8
 OTHER_FILES = [
-    'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h'
+    'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
+    'compiler.h'
 ]
+API_MODULE_PREFIX = "_chelper_"
+API_COMPILE_ARGS = ['-Wall', '-O2']
+API_SOURCE_HEADER = """
+#include <stdint.h>
+struct serialqueue; struct command_queue; struct stepcompress;
+struct steppersync; struct move; struct stepper_kinematics;
+"""
 
 defs_stepcompress = """
     struct stepcompress *stepcompress_alloc(uint32_t oid);
@@ -98,7 +111,15 @@ defs_serialqueue = """
         , int receive_window);
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
         , double last_clock_time, uint64_t last_clock);
+    struct serialqueue_stats {
+        uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+        uint64_t send_seq, receive_seq, retransmit_seq;
+        double srtt, rttvar, rto;
+        int ready_bytes, stalled_bytes;
+    };
     void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+    void serialqueue_get_stats_data(struct serialqueue *sq
+        , struct serialqueue_stats *stats);
     int serialqueue_extract_old(struct serialqueue *sq, int sentq
         , struct pull_queue_message *q, int max);
 """
@@ -117,7 +138,54 @@ defs_all = [
     defs_kin_cartesian, defs_kin_corexy, defs_kin_delta, defs_kin_extruder
 ]
 
-# Return the list of file modification times
+# Return a hash of the contents of the given files along with any
+# extra strings (such as the compile command) that affect the build
+def get_build_key(srcdir, filelist, extra=[]):
+    h = hashlib.sha1()
+    for filename in filelist:
+        try:
+            f = open(os.path.join(srcdir, filename), 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            data = ""
+        h.update("%s\0%d\0" % (filename, len(data)))
+        h.update(data)
+    for e in extra:
+        h.update(e + "\0")
+    return h.hexdigest()[:16]
+
+# Builds are stored in a cache directory under a name containing the
+# build key, so several builds (eg, from different git branches) can
+# be kept side by side.  Returns None if the cache directory can not
+# be created (eg, the klippy tree is not writable).
+def get_build_cache_path(srcdir, filename):
+    cachedir = os.path.join(srcdir, BUILD_CACHE_DIR)
+    try:
+        if not os.path.isdir(cachedir):
+            os.mkdir(cachedir)
+    except OSError as e:
+        logging.warning("Unable to create build cache %s: %s", cachedir, e)
+        return None
+    return os.path.join(cachedir, filename)
+
+def note_build_cache_use(path, prefix):
+    cachedir = os.path.dirname(path)
+    try:
+        # Update the mtime so that the least recently used builds
+        # are the ones that get removed
+        os.utime(path, None)
+        builds = []
+        for filename in os.listdir(cachedir):
+            if filename.startswith(prefix):
+                pathname = os.path.join(cachedir, filename)
+                builds.append((os.path.getmtime(pathname), pathname))
+        builds.sort(reverse=True)
+        for mtime, pathname in builds[BUILD_CACHE_SIZE:]:
+            os.remove(pathname)
+    except OSError:
+        logging.exception("Unable to update build cache %s", cachedir)
+
 def get_mtimes(srcdir, filelist):
     out = []
     for filename in filelist:
@@ -129,15 +197,125 @@ def get_mtimes(srcdir, filelist):
         out.append(t)
     return out
 
-# Check if the code needs to be compiled
-def check_build_code(srcdir, target, sources, cmd, other_files=[]):
+# Build target in srcdir if it is older than its sources and return
+# its path (or None if there is no build).  This is used when the
+# build cache can not be used.
+def check_build_code_in_tree(srcdir, target, sources, cmd, other_files=[]):
     src_times = get_mtimes(srcdir, sources + other_files)
     obj_times = get_mtimes(srcdir, [target])
+    destpath = os.path.join(srcdir, target)
     if not obj_times or max(src_times) > min(obj_times):
         logging.info("Building C code module %s", target)
         srcfiles = [os.path.join(srcdir, fname) for fname in sources]
-        destlib = os.path.join(srcdir, target)
-        os.system(cmd % (destlib, ' '.join(srcfiles)))
+        ret = os.system(cmd % (destpath, ' '.join(srcfiles)))
+        if ret:
+            logging.error("Build of %s failed (%s)", target, ret)
+    if not os.path.exists(destpath):
+        return None
+    return destpath
+
+# Build the code (if a build with the same key isn't cached) and
+# return the path to the resulting file (or None if the build failed)
+def check_build_code(srcdir, target, sources, cmd, other_files=[]):
+    key = get_build_key(srcdir, sources + other_files, [cmd])
+    base, ext = os.path.splitext(target)
+    destpath = get_build_cache_path(srcdir, "%s-%s%s" % (base, key, ext))
+    if destpath is None or (not os.path.exists(destpath) and not os.access(
+            os.path.dirname(destpath), os.W_OK)):
+        return check_build_code_in_tree(srcdir, target, sources, cmd,
+                                        other_files)
+    if not os.path.exists(destpath):
+        logging.info("Building C code module %s", target)
+        start_time = time.time()
+        srcfiles = [os.path.join(srcdir, fname) for fname in sources]
+        tmppath = destpath + ".tmp"
+        ret = os.system(cmd % (tmppath, ' '.join(srcfiles)))
+        if ret or not os.path.exists(tmppath):
+            logging.error("Build of %s failed (%s)", target, ret)
+            return None
+        os.rename(tmppath, destpath)
+        logging.info("Built %s in %.3f seconds", target,
+                     time.time() - start_time)
+    note_build_cache_use(destpath, base + "-")
+    return destpath
+
+
+######################################################################
+# cffi module loading
+######################################################################
+
+# The "API mode" module is a python extension built from the C code
+# with cffi.  It is named after a hash of its sources so that it can
+# be imported directly without any cdef parsing at startup.
+def get_api_module_name(srcdir):
+    return API_MODULE_PREFIX + get_build_key(
+        srcdir, SOURCE_FILES + OTHER_FILES, defs_all + API_COMPILE_ARGS
+        + [API_SOURCE_HEADER, cffi.__version__])
+
+def build_api_module(srcdir, modname, destpath):
+    logging.info("Building C code module %s", modname)
+    start_time = time.time()
+    ffibuilder = cffi.FFI()
+    for d in defs_all:
+        ffibuilder.cdef(d)
+    ffibuilder.set_source(
+        modname, API_SOURCE_HEADER + "".join(defs_all),
+        sources=[os.path.join(srcdir, fname) for fname in SOURCE_FILES],
+        include_dirs=[srcdir], extra_compile_args=API_COMPILE_ARGS)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        libpath = ffibuilder.compile(tmpdir=tmpdir)
+        shutil.copyfile(libpath, destpath + ".tmp")
+        os.rename(destpath + ".tmp", destpath)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    logging.info("Built %s in %.3f seconds", modname,
+                 time.time() - start_time)
+
+# A failed build (eg, on a host without the python headers) is noted
+# with a marker file so that later starts go straight to the fallback
+# instead of repeating the build.  Remove the marker to retry.
+def load_api_module(srcdir):
+    modname = get_api_module_name(srcdir)
+    libpath = get_build_cache_path(srcdir, modname + ".so")
+    if libpath is None:
+        return None
+    failpath = get_build_cache_path(srcdir, modname + ".failed")
+    if os.path.exists(failpath):
+        note_build_cache_use(failpath, API_MODULE_PREFIX)
+        logging.info("C helper extension module %s previously failed to"
+                     " build (see %s)", modname, failpath)
+        return None
+    if not os.path.exists(libpath):
+        try:
+            build_api_module(srcdir, modname, libpath)
+        except Exception:
+            # Building python extensions requires the python headers
+            logging.exception("Unable to build C helper extension module")
+            try:
+                f = open(failpath, 'wb')
+                f.write(traceback.format_exc())
+                f.close()
+            except IOError:
+                logging.exception("Unable to write %s", failpath)
+            return None
+    note_build_cache_use(libpath, API_MODULE_PREFIX)
+    module = imp.load_dynamic(modname, libpath)
+    return module.ffi, module.lib
+
+# The "ABI mode" fallback parses the cdefs and calls the functions in
+# c_helper.so via libffi
+def load_abi_module(srcdir):
+    libpath = check_build_code(srcdir, DEST_LIB, SOURCE_FILES, COMPILE_CMD
+                               , OTHER_FILES)
+    if libpath is None:
+        raise error("Unable to build C helper code %s (see log)" % (
+            DEST_LIB,))
+    ffi_main = cffi.FFI()
+    for d in defs_all:
+        ffi_main.cdef(d)
+    ffi_lib = ffi_main.dlopen(libpath)
+    return ffi_main, ffi_lib
 
 FFI_main = None
 FFI_lib = None
@@ -148,17 +326,20 @@ def get_ffi():
     global FFI_main, FFI_lib, pyhelper_logging_callback
     if FFI_lib is None:
         srcdir = os.path.dirname(os.path.realpath(__file__))
-        check_build_code(srcdir, DEST_LIB, SOURCE_FILES, COMPILE_CMD
-                         , OTHER_FILES)
-        FFI_main = cffi.FFI()
-        for d in defs_all:
-            FFI_main.cdef(d)
-        FFI_lib = FFI_main.dlopen(os.path.join(srcdir, DEST_LIB))
+        try:
+            res = load_api_module(srcdir)
+        except Exception:
+            logging.exception("Unable to load C helper extension module")
+            res = None
+        if res is None:
+            logging.info("Using c_helper.so for the C helper code")
+            res = load_abi_module(srcdir)
+        FFI_main, FFI_lib = res
         # Setup error logging
         def logging_callback(msg):
             logging.error(FFI_main.string(msg))
         pyhelper_logging_callback = FFI_main.callback(
-            "void(const char *)", logging_callback)
+            "void(*)(const char *)", logging_callback)
         FFI_lib.set_python_logging_callback(pyhelper_logging_callback)
     return FFI_main, FFI_lib
 
@@ -173,8 +354,14 @@ HC_SOURCE_DIR = '../../lib/hub-ctrl'
 HC_TARGET = "hub-ctrl"
 HC_CMD = "sudo %s/hub-ctrl -h 0 -P 2 -p %d"
 
+# hub-ctrl is run via sudo, so it is always built in place (and not in
+# the build cache) to keep it at a fixed path for sudoers rules
 def run_hub_ctrl(enable_power):
     srcdir = os.path.dirname(os.path.realpath(__file__))
     hubdir = os.path.join(srcdir, HC_SOURCE_DIR)
-    check_build_code(hubdir, HC_TARGET, HC_SOURCE_FILES, HC_COMPILE_CMD)
+    if check_build_code_in_tree(hubdir, HC_TARGET, HC_SOURCE_FILES,
+                                HC_COMPILE_CMD) is None:
+        logging.error("Unable to build %s - not changing hub power",
+                      HC_TARGET)
+        return
     os.system(HC_CMD % (hubdir, enable_power))
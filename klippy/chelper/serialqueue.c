@@ -1056,10 +1056,8 @@ serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
 void __visible
 serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
 {
-    struct serialqueue stats;
-    pthread_mutex_lock(&sq->lock);
-    memcpy(&stats, sq, sizeof(stats));
-    pthread_mutex_unlock(&sq->lock);
+    struct serialqueue_stats stats;
+    serialqueue_get_stats_data(sq, &stats);
 
     snprintf(buf, len, "bytes_write=%u bytes_read=%u"
              " bytes_retransmit=%u bytes_invalid=%u"
@@ -1074,6 +1072,27 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              , stats.ready_bytes, stats.stalled_bytes);
 }
 
+// Return the current statistics as individual values
+void __visible
+serialqueue_get_stats_data(struct serialqueue *sq
+                           , struct serialqueue_stats *stats)
+{
+    pthread_mutex_lock(&sq->lock);
+    stats->bytes_write = sq->bytes_write;
+    stats->bytes_read = sq->bytes_read;
+    stats->bytes_retransmit = sq->bytes_retransmit;
+    stats->bytes_invalid = sq->bytes_invalid;
+    stats->send_seq = sq->send_seq;
+    stats->receive_seq = sq->receive_seq;
+    stats->retransmit_seq = sq->retransmit_seq;
+    stats->srtt = sq->srtt;
+    stats->rttvar = sq->rttvar;
+    stats->rto = sq->rto;
+    stats->ready_bytes = sq->ready_bytes;
+    stats->stalled_bytes = sq->stalled_bytes;
+    pthread_mutex_unlock(&sq->lock);
+}
+
 // Extract old messages stored in the debug queues
 int __visible
 serialqueue_extract_old(struct serialqueue *sq, int sentq
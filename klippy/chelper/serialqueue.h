@@ -44,6 +44,13 @@ struct pull_queue_message {
     double sent_time, receive_time;
 };
 
+struct serialqueue_stats {
+    uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint64_t send_seq, receive_seq, retransmit_seq;
+    double srtt, rttvar, rto;
+    int ready_bytes, stalled_bytes;
+};
+
 struct serialqueue;
 struct serialqueue *serialqueue_alloc(int serial_fd, int write_only);
 void serialqueue_exit(struct serialqueue *sq);
@@ -63,6 +70,8 @@ void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
                                , double last_clock_time, uint64_t last_clock);
 void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+void serialqueue_get_stats_data(struct serialqueue *sq
+                                , struct serialqueue_stats *stats);
 int serialqueue_extract_old(struct serialqueue *sq, int sentq
                             , struct pull_queue_message *q, int max);
 
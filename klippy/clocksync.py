@@ -27,6 +27,7 @@ class ClockSync:
         self.clock_avg = self.clock_covariance = 0.
         self.prediction_variance = 0.
         self.last_prediction_time = 0.
+        self.binlogger = self.binlog_type = None
     def connect(self, serial):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
@@ -118,6 +119,9 @@ class ClockSync:
                                   int(self.clock_avg - 3. * pred_stddev))
         self.clock_est = (self.time_avg + self.min_half_rtt,
                           self.clock_avg, new_freq)
+        if self.binlogger is not None:
+            self.binlogger.log(self.binlog_type, receive_time, (
+                sent_time, receive_time, clock, new_freq, pred_stddev))
         #logging.debug("regr %.3f: freq=%.3f d=%d(%.3f)",
         #              sent_time, new_freq, clock - exp_clock, pred_stddev)
     # clock frequency conversions
@@ -156,6 +160,20 @@ class ClockSync:
     def stats(self, eventtime):
         sample_time, clock, freq = self.clock_est
         return "freq=%d" % (freq,)
+    def setup_binary_log(self, binlogger, name):
+        self.binlogger = binlogger
+        self.binlog_type = binlogger.register_type(
+            "clocksync %s" % (name,),
+            ['sent_time', 'receive_time', 'clock', 'freq', 'pred_stddev'],
+            'ddqdd')
+    def register_metrics(self, metrics, **labels):
+        metrics.register_group(self.get_metrics, [
+            ('clock_freq', 'gauge', "Estimated mcu clock frequency"),
+            ('clock_adj_freq', 'gauge', "Adjusted secondary mcu frequency")],
+                               **labels)
+    def get_metrics(self, eventtime):
+        sample_time, clock, freq = self.clock_est
+        return {'clock_freq': freq}
     def calibrate_clock(self, print_time, eventtime):
         return (0., self.mcu_freq)
 
@@ -196,6 +214,10 @@ class SecondarySync(ClockSync):
     def stats(self, eventtime):
         adjusted_offset, adjusted_freq = self.clock_adj
         return "%s adj=%d" % (ClockSync.stats(self, eventtime), adjusted_freq)
+    def get_metrics(self, eventtime):
+        res = ClockSync.get_metrics(self, eventtime)
+        res['clock_adj_freq'] = self.clock_adj[1]
+        return res
     def calibrate_clock(self, print_time, eventtime):
         # Calculate: est_print_time = main_sync.estimatated_print_time()
         ser_time, ser_clock, ser_freq = self.main_sync.clock_est
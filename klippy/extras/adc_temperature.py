@@ -18,6 +18,7 @@ class Linear:
         self.temperature_callback = None
         self.adc_samples = []
         self.slope_samples = []
+        self.temp_samples = []
         self.calc_coefficients(config, params)
     def calc_coefficients(self, config, params):
         adc_voltage = config.getfloat('adc_voltage', 5., above=0.)
@@ -47,6 +48,10 @@ class Linear:
             raise config.error(
                 "adc_temperature needs two volt and temperature measurements")
         self.adc_samples[-1] = 1.
+        # Precompute the temperature at the end of each segment
+        self.temp_samples = [
+            adc * gain + offset for adc, (gain, offset) in zip(
+                self.adc_samples, self.slope_samples)]
     def setup_minmax(self, min_temp, max_temp):
         adc_range = [self.calc_adc(min_temp), self.calc_adc(max_temp)]
         self.mcu_adc.setup_minmax(SAMPLE_TIME, SAMPLE_COUNT,
@@ -61,14 +66,18 @@ class Linear:
         temp = read_value * gain + offset
         self.temperature_callback(read_time + SAMPLE_COUNT * SAMPLE_TIME, temp)
     def calc_adc(self, temp):
-        temps = [adc * gain + offset for adc, (gain, offset) in zip(
-            self.adc_samples, self.slope_samples)]
+        temps = self.temp_samples
+        pos = len(temps) - 1
         if temps[0] < temps[-1]:
-            pos = min([i for i in range(len(temps)) if temps[i] >= temp]
-                      + [len(temps) - 1])
+            for i, t in enumerate(temps):
+                if t >= temp:
+                    pos = i
+                    break
         else:
-            pos = min([i for i in range(len(temps)) if temps[i] <= temp]
-                      + [len(temps) - 1])
+            for i, t in enumerate(temps):
+                if t <= temp:
+                    pos = i
+                    break
         gain, offset = self.slope_samples[pos]
         return (temp - offset) / gain
 
@@ -0,0 +1,285 @@
+# Local unix domain socket server for G-Code and status requests
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, socket, errno, json, logging
+
+# Requests and responses are JSON objects terminated by a newline:
+#   {"id": 1, "method": "gcode/script", "params": {"script": "G28"}}
+#   {"id": 2, "method": "objects/list"}
+#   {"id": 3, "method": "objects/query", "params": {"objects": ["fan"]}}
+#   {"id": 4, "method": "objects/subscribe",
+#    "params": {"objects": ["toolhead", "heater_bed"], "interval": 0.5}}
+#   {"id": 5, "method": "metrics/export"}
+# Every request is answered with {"id": <id>, "result": <result>} or
+# {"id": <id>, "error": <message>}.  The result of "gcode/script" is
+# {"output": [<response>, ...]} with the responses (eg, "// ..." info
+# messages and M105 temperature reports) to the script's commands.  If
+# a command fails the script is stopped and the error reply also holds
+# the "output" of the commands that were run.  Subscribed objects are pushed to
+# the client as {"status": {...}, "eventtime": <time>} messages.
+
+MIN_INTERVAL = 0.050
+MAX_PENDING_REQUESTS = 20
+MAX_REQUEST_SIZE = 64 * 1024
+
+class ClientConnection:
+    def __init__(self, server, sock):
+        self.server = server
+        self.reactor = server.reactor
+        self.sock = sock
+        self.fd_handle = self.reactor.register_fd(
+            sock.fileno(), self.process_received)
+        self.is_closed = False
+        self.partial_data = ""
+        self.pending_requests = []
+        self.is_processing = False
+        # Status subscription
+        self.sub_objects = []
+        self.sub_interval = 0.
+        self.sub_next_time = self.reactor.NEVER
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        if self.fd_handle is not None:
+            self.reactor.unregister_fd(self.fd_handle)
+            self.fd_handle = None
+        self.sock.close()
+        self.server.remove_client(self)
+    def send(self, msg):
+        if self.is_closed:
+            return
+        data = json.dumps(msg, separators=(',', ':')) + "\n"
+        try:
+            self.sock.sendall(data)
+        except socket.error as e:
+            # The client is not reading its responses
+            logging.info("api_server: dropping client (%s)", str(e))
+            self.close()
+    def process_received(self, eventtime):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            self.close()
+            return
+        requests = (self.partial_data + data).split('\n')
+        self.partial_data = requests.pop()
+        if len(self.partial_data) > MAX_REQUEST_SIZE:
+            logging.info("api_server: request too large")
+            self.close()
+            return
+        self.pending_requests.extend(requests)
+        if self.is_processing:
+            if len(self.pending_requests) >= MAX_PENDING_REQUESTS:
+                # Stop reading input until pending requests complete
+                self.reactor.unregister_fd(self.fd_handle)
+                self.fd_handle = None
+            return
+        self.is_processing = True
+        while self.pending_requests and not self.is_closed:
+            requests = self.pending_requests
+            self.pending_requests = []
+            for request in requests:
+                self.process_request(request)
+        self.is_processing = False
+        if self.fd_handle is None and not self.is_closed:
+            self.fd_handle = self.reactor.register_fd(
+                self.sock.fileno(), self.process_received)
+    def process_request(self, request):
+        request = request.strip()
+        if not request:
+            return
+        try:
+            request = json.loads(request)
+            req_id = request.get('id')
+            method = str(request['method'])
+            params = request.get('params', {})
+            if not isinstance(params, dict):
+                raise ValueError("params must be an object")
+        except (ValueError, KeyError, AttributeError, UnicodeError) as e:
+            self.send({'id': None, 'error': "Malformed request"})
+            return
+        handler = self.server.methods.get(method)
+        if handler is None:
+            self.send({'id': req_id, 'error': "Unknown method '%s'" % (
+                method,)})
+            return
+        gcode = self.server.gcode
+        try:
+            result = handler(self, params)
+        except gcode.error as e:
+            msg = {'id': req_id, 'error': str(e)}
+            if hasattr(e, 'output'):
+                msg['output'] = e.output
+            self.send(msg)
+            return
+        except:
+            msg = "Internal error on api request '%s'" % (method,)
+            logging.exception(msg)
+            self.send({'id': req_id, 'error': msg})
+            return
+        self.send({'id': req_id, 'result': result})
+    def subscribe(self, names, interval):
+        self.sub_objects = names
+        self.sub_interval = interval
+        self.sub_next_time = self.reactor.NEVER
+        if names:
+            self.sub_next_time = self.reactor.monotonic() + interval
+            self.server.note_subscription(self.sub_next_time)
+    def send_status(self, eventtime):
+        self.sub_next_time = max(self.sub_next_time + self.sub_interval,
+                                 eventtime)
+        status = self.server.query_status(self.sub_objects, eventtime)
+        self.send({'status': status, 'eventtime': eventtime})
+
+class APIServer:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.socket_path = os.path.expanduser(
+            config.get('path', '/tmp/klippy_uds'))
+        self.sock = self.fd_handle = None
+        self.clients = []
+        self.status_objects = {}
+        self.status_timer = self.reactor.register_timer(self.status_event)
+        self.methods = {
+            'gcode/script': self.handle_gcode_script,
+            'objects/list': self.handle_objects_list,
+            'objects/query': self.handle_objects_query,
+            'objects/subscribe': self.handle_objects_subscribe,
+            'metrics/export': self.handle_metrics_export }
+    def printer_state(self, state):
+        if state == 'connect':
+            self.open_socket()
+        elif state == 'ready':
+            self.status_objects = {
+                name: obj for name, obj in self.printer.objects.items()
+                if hasattr(obj, 'get_status') }
+        elif state == 'disconnect':
+            self.close_socket()
+    def stats(self, eventtime):
+        if not self.clients:
+            return False, ""
+        return False, "api_clients=%d" % (len(self.clients),)
+    # Socket handling
+    def open_socket(self):
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.socket_path)
+            sock.listen(5)
+        except socket.error as e:
+            sock.close()
+            logging.exception("api_server: unable to open socket")
+            raise self.printer.config_error(
+                "Unable to open api socket %s: %s" % (self.socket_path, e))
+        sock.setblocking(0)
+        self.sock = sock
+        self.fd_handle = self.reactor.register_fd(
+            sock.fileno(), self.accept_client)
+    def close_socket(self):
+        for client in list(self.clients):
+            client.close()
+        if self.sock is None:
+            return
+        self.reactor.unregister_fd(self.fd_handle)
+        self.sock.close()
+        self.sock = self.fd_handle = None
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+    def accept_client(self, eventtime):
+        try:
+            sock, addr = self.sock.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self.clients.append(ClientConnection(self, sock))
+    def remove_client(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+    # Status reporting
+    def query_status(self, names, eventtime):
+        status = {}
+        for name in names:
+            obj = self.status_objects.get(name)
+            if obj is None:
+                raise self.gcode.error("Unknown status object '%s'" % (name,))
+            status[name] = obj.get_status(eventtime)
+        return status
+    def note_subscription(self, waketime):
+        if waketime < self.status_timer.waketime:
+            self.reactor.update_timer(self.status_timer, waketime)
+    def status_event(self, eventtime):
+        next_time = self.reactor.NEVER
+        for client in list(self.clients):
+            if client.sub_next_time <= eventtime:
+                client.send_status(eventtime)
+            if not client.is_closed:
+                next_time = min(next_time, client.sub_next_time)
+        return next_time
+    # Request handlers
+    def get_object_names(self, params):
+        names = params.get('objects', [])
+        if not isinstance(names, list):
+            raise self.gcode.error("objects must be a list")
+        try:
+            names = [str(name) for name in names]
+        except UnicodeError:
+            raise self.gcode.error("Invalid object name")
+        for name in names:
+            if name not in self.status_objects:
+                raise self.gcode.error("Unknown status object '%s'" % (name,))
+        return names
+    def handle_gcode_script(self, client, params):
+        try:
+            script = str(params['script'])
+        except (KeyError, UnicodeError):
+            raise self.gcode.error("Missing or invalid script")
+        output = []
+        try:
+            for line in script.split('\n'):
+                # Wait for the gcode input stream to be idle
+                while not self.gcode.process_batch(line, output):
+                    if client.is_closed:
+                        return {'output': output}
+                    self.reactor.pause(self.reactor.monotonic() + 0.100)
+        except self.gcode.error as e:
+            e.output = output
+            raise
+        return {'output': output}
+    def handle_objects_list(self, client, params):
+        return {'objects': sorted(self.status_objects)}
+    def handle_objects_query(self, client, params):
+        names = self.get_object_names(params)
+        eventtime = self.reactor.monotonic()
+        return {'status': self.query_status(names, eventtime),
+                'eventtime': eventtime}
+    def handle_objects_subscribe(self, client, params):
+        names = self.get_object_names(params)
+        try:
+            interval = max(MIN_INTERVAL, float(params.get('interval', 1.)))
+        except (TypeError, ValueError):
+            raise self.gcode.error("Invalid interval")
+        client.subscribe(names, interval)
+        eventtime = self.reactor.monotonic()
+        return {'status': self.query_status(names, eventtime),
+                'eventtime': eventtime, 'interval': interval}
+
+    def handle_metrics_export(self, client, params):
+        metrics = self.printer.lookup_object('metrics')
+        return {'text': metrics.export_text(self.reactor.monotonic())}
+
+def load_config(config):
+    return APIServer(config)
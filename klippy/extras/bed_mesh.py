@@ -0,0 +1,226 @@
+# Bed mesh compensation
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
+import probe
+
+def parse_pair(config, option, default=None, conv=float):
+    value = config.get(option, default)
+    try:
+        parts = [conv(p.strip()) for p in value.split(',')]
+    except:
+        raise config.error("Unable to parse %s in %s" % (
+            option, config.get_name()))
+    if len(parts) != 2:
+        raise config.error("%s in %s must have two values" % (
+            option, config.get_name()))
+    return parts
+
+# Bilinear interpolation of a grid of probed Z heights.  The grid is
+# stored as a list of rows (one per Y coordinate).  The coefficients
+# of each cell are calculated up front so that a height lookup only
+# needs to locate the cell and evaluate z = a + b*u + c*v + d*u*v
+# (where u and v are the position within the cell from 0 to 1).
+# Positions outside the grid use the height at the nearest grid edge.
+class ZMesh:
+    def __init__(self, min_x, min_y, max_x, max_y, matrix):
+        self.matrix = matrix
+        self.x_count = len(matrix[0])
+        self.y_count = len(matrix)
+        self.min_x, self.min_y = min_x, min_y
+        self.x_dist = (max_x - min_x) / (self.x_count - 1)
+        self.y_dist = (max_y - min_y) / (self.y_count - 1)
+        self.x_scale = 1. / self.x_dist
+        self.y_scale = 1. / self.y_dist
+        self.max_cell_x = self.x_count - 2
+        self.max_cell_y = self.y_count - 2
+        self.coeffs = []
+        for j in range(self.y_count - 1):
+            for i in range(self.x_count - 1):
+                z00 = matrix[j][i]
+                z10 = matrix[j][i+1]
+                z01 = matrix[j+1][i]
+                z11 = matrix[j+1][i+1]
+                self.coeffs.append((z00, z10 - z00, z01 - z00,
+                                    z11 - z10 - z01 + z00))
+    def get_cell(self, x, y):
+        # Return the cell indexes and the position within that cell
+        u = (x - self.min_x) * self.x_scale
+        v = (y - self.min_y) * self.y_scale
+        i = min(max(int(u), 0), self.max_cell_x)
+        j = min(max(int(v), 0), self.max_cell_y)
+        return i, j, min(max(u - i, 0.), 1.), min(max(v - j, 0.), 1.)
+    def calc_z(self, x, y):
+        i, j, u, v = self.get_cell(x, y)
+        a, b, c, d = self.coeffs[j * (self.x_count - 1) + i]
+        return a + b*u + c*v + d*u*v
+    def split_move(self, prev_pos, prev_cell, newpos):
+        # Return the list of positions (with adjusted Z) that the move
+        # from prev_pos (in grid cell prev_cell) to newpos should be
+        # broken into, along with the grid cell of newpos.  A move is
+        # only split where it crosses the boundary of a grid cell.
+        x1, y1, z1, e1 = newpos
+        u = (x1 - self.min_x) * self.x_scale
+        v = (y1 - self.min_y) * self.y_scale
+        i1 = min(max(int(u), 0), self.max_cell_x)
+        j1 = min(max(int(v), 0), self.max_cell_y)
+        cell = j1 * (self.x_count - 1) + i1
+        if cell == prev_cell:
+            # Fast path - move within a single cell
+            u = min(max(u - i1, 0.), 1.)
+            v = min(max(v - j1, 0.), 1.)
+            a, b, c, d = self.coeffs[cell]
+            return [[x1, y1, z1 + a + b*u + c*v + d*u*v, e1]], cell
+        # Find the fraction of the move at each cell boundary crossing
+        x0, y0, z0, e0 = prev_pos
+        i0, j0 = self.get_cell(x0, y0)[:2]
+        dx, dy = x1 - x0, y1 - y0
+        splits = []
+        if i0 != i1:
+            for i in range(min(i0, i1) + 1, max(i0, i1) + 1):
+                splits.append((self.min_x + i * self.x_dist - x0) / dx)
+        if j0 != j1:
+            for j in range(min(j0, j1) + 1, max(j0, j1) + 1):
+                splits.append((self.min_y + j * self.y_dist - y0) / dy)
+        splits.sort()
+        # Calculate the position and height of each segment end
+        calc_z = self.calc_z
+        dz, de = z1 - z0, e1 - e0
+        moves = []
+        last_t = 0.
+        for t in splits:
+            if t <= last_t or t >= 1.:
+                continue
+            last_t = t
+            x, y = x0 + dx*t, y0 + dy*t
+            moves.append([x, y, z0 + dz*t + calc_z(x, y), e0 + de*t])
+        moves.append([x1, y1, z1 + calc_z(x1, y1), e1])
+        return moves, cell
+    def get_cell_index(self, x, y):
+        i, j, u, v = self.get_cell(x, y)
+        return j * (self.x_count - 1) + i
+    def get_range(self):
+        heights = [z for row in self.matrix for z in row]
+        return min(heights), max(heights)
+
+class BedMesh:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.toolhead = None
+        self.z_mesh = None
+        self.last_position = [0., 0., 0., 0.]
+        self.last_cell = -1
+        self.calibrate = BedMeshCalibrate(config, self)
+        # Register transform and commands
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.set_move_transform(self)
+        self.gcode.register_command(
+            'BED_MESH_OUTPUT', self.cmd_BED_MESH_OUTPUT,
+            desc=self.cmd_BED_MESH_OUTPUT_help)
+        self.gcode.register_command(
+            'BED_MESH_CLEAR', self.cmd_BED_MESH_CLEAR,
+            desc=self.cmd_BED_MESH_CLEAR_help)
+    def printer_state(self, state):
+        if state == 'connect':
+            self.toolhead = self.printer.lookup_object('toolhead')
+    def set_mesh(self, z_mesh):
+        self.z_mesh = z_mesh
+        self.gcode.reset_last_position()
+    def get_position(self):
+        x, y, z, e = self.toolhead.get_position()
+        if self.z_mesh is not None:
+            z -= self.z_mesh.calc_z(x, y)
+            self.last_cell = self.z_mesh.get_cell_index(x, y)
+        self.last_position = [x, y, z, e]
+        return list(self.last_position)
+    def move(self, newpos, speed):
+        if self.z_mesh is None:
+            self.last_position[:] = newpos
+            self.toolhead.move(newpos, speed)
+            return
+        moves, self.last_cell = self.z_mesh.split_move(
+            self.last_position, self.last_cell, newpos)
+        self.last_position[:] = newpos
+        for pos in moves:
+            self.toolhead.move(pos, speed)
+    cmd_BED_MESH_OUTPUT_help = "Report the probed bed mesh heights"
+    def cmd_BED_MESH_OUTPUT(self, params):
+        if self.z_mesh is None:
+            self.gcode.respond_info("Bed mesh not calibrated")
+            return
+        z_mesh = self.z_mesh
+        lines = ["Bed mesh (%d x %d points, %.3f x %.3f mm cells):" % (
+            z_mesh.x_count, z_mesh.y_count, z_mesh.x_dist, z_mesh.y_dist)]
+        for j in range(z_mesh.y_count - 1, -1, -1):
+            lines.append(" ".join(["%8.4f" % (z,) for z in z_mesh.matrix[j]]))
+        lines.append("z range: %.4f to %.4f" % z_mesh.get_range())
+        self.gcode.respond_info("\n".join(lines))
+    cmd_BED_MESH_CLEAR_help = "Clear the bed mesh"
+    def cmd_BED_MESH_CLEAR(self, params):
+        self.set_mesh(None)
+
+# Helper script to probe the bed mesh
+class BedMeshCalibrate:
+    def __init__(self, config, bedmesh):
+        self.printer = config.get_printer()
+        self.bedmesh = bedmesh
+        self.min_x, self.min_y = parse_pair(config, 'min_point')
+        self.max_x, self.max_y = parse_pair(config, 'max_point')
+        if self.max_x <= self.min_x or self.max_y <= self.min_y:
+            raise config.error("bed_mesh max_point must be greater than"
+                               " min_point")
+        self.x_count, self.y_count = parse_pair(
+            config, 'probe_count', '3,3', int)
+        if self.x_count < 2 or self.y_count < 2:
+            raise config.error("bed_mesh probe_count must be at least 2,2")
+        # Probe the points in a zig-zag pattern to reduce travel
+        x_dist = (self.max_x - self.min_x) / (self.x_count - 1)
+        y_dist = (self.max_y - self.min_y) / (self.y_count - 1)
+        points = []
+        for j in range(self.y_count):
+            row = range(self.x_count)
+            if j & 1:
+                row.reverse()
+            for i in row:
+                points.append((self.min_x + i * x_dist,
+                               self.min_y + j * y_dist))
+        self.probe_helper = probe.ProbePointsHelper(
+            config, self, default_points=points)
+        # Register BED_MESH_CALIBRATE command
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command(
+            'BED_MESH_CALIBRATE', self.cmd_BED_MESH_CALIBRATE,
+            desc=self.cmd_BED_MESH_CALIBRATE_help)
+    cmd_BED_MESH_CALIBRATE_help = "Probe the bed and build a bed mesh"
+    def cmd_BED_MESH_CALIBRATE(self, params):
+        self.bedmesh.set_mesh(None)
+        self.gcode.run_script("G28")
+        self.probe_helper.start_probe()
+    def get_position(self):
+        kin = self.printer.lookup_object('toolhead').get_kinematics()
+        return kin.get_position()
+    def finalize(self, z_offset, positions):
+        logging.info("Calculating bed_mesh with: %s", positions)
+        matrix = [[0.] * self.x_count for j in range(self.y_count)]
+        for j in range(self.y_count):
+            for i in range(self.x_count):
+                if j & 1:
+                    pos = positions[j * self.x_count + self.x_count - 1 - i]
+                else:
+                    pos = positions[j * self.x_count + i]
+                matrix[j][i] = pos[2] - z_offset
+        z_mesh = ZMesh(self.min_x, self.min_y, self.max_x, self.max_y, matrix)
+        self.bedmesh.set_mesh(z_mesh)
+        z_min, z_max = z_mesh.get_range()
+        logging.info("Calculated bed_mesh: %s", matrix)
+        self.printer.set_rollover_info("bed_mesh", "bed_mesh: %s" % (matrix,))
+        self.gcode.respond_info(
+            "Bed mesh calibrated (%d points, z range %.4f to %.4f).\n"
+            "The mesh has been applied to the current session. Use\n"
+            "BED_MESH_OUTPUT to view it." % (
+                len(positions), z_min, z_max))
+
+def load_config(config):
+    return BedMesh(config)
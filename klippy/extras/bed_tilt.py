@@ -61,13 +61,10 @@ class BedTiltCalibrate:
             x, y, z = pos
             return (z - x*params['x_adjust'] - y*params['y_adjust']
                     - params['z_adjust'])
-        def errorfunc(params):
-            total_error = 0.
-            for pos in positions:
-                total_error += adjusted_height(pos, params)**2
-            return total_error
-        new_params = mathutil.coordinate_descent(
-            params.keys(), params, errorfunc)
+        def residuals(params):
+            return [adjusted_height(pos, params) for pos in positions]
+        new_params, new_residuals = self.probe_helper.calc_least_squares(
+            params.keys(), params, residuals)
         logging.info("Calculated bed_tilt parameters: %s", new_params)
         for pos in positions:
             logging.info("orig: %s new: %s", adjusted_height(pos, params),
@@ -101,9 +98,10 @@ class BedTiltCalibrate:
             z_adjust, new_params['x_adjust'], new_params['y_adjust'])
         self.printer.set_rollover_info("bed_tilt", "bed_tilt: %s" % (msg,))
         self.gcode.respond_info(
-            "%s\nThe above parameters have been applied to the current\n"
+            "%s\n(%s)\nThe above parameters have been applied to the current\n"
             "session. Update the printer config file with the above to\n"
-            "use these settings in future sessions." % (msg,))
+            "use these settings in future sessions." % (
+                msg, mathutil.format_residuals(new_residuals)))
 
 def load_config(config):
     return BedTilt(config)
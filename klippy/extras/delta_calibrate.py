@@ -40,14 +40,11 @@ class DeltaCalibrate:
         logging.info("Initial delta_calibrate parameters: %s", params)
         adj_params = ('endstop_a', 'endstop_b', 'endstop_c', 'radius',
                       'angle_a', 'angle_b')
-        def delta_errorfunc(params):
-            total_error = 0.
-            for spos in positions:
-                x, y, z = delta.get_position_from_stable(spos, params)
-                total_error += (z - z_offset)**2
-            return total_error
-        new_params = mathutil.coordinate_descent(
-            adj_params, params, delta_errorfunc)
+        def delta_residuals(params):
+            return [delta.get_position_from_stable(spos, params)[2] - z_offset
+                    for spos in positions]
+        new_params, new_residuals = self.probe_helper.calc_least_squares(
+            adj_params, params, delta_residuals)
         logging.info("Calculated delta_calibrate parameters: %s", new_params)
         for spos in positions:
             logging.info("orig: %s new: %s",
@@ -58,12 +55,14 @@ class DeltaCalibrate:
             "stepper_b: position_endstop: %.6f angle: %.6f\n"
             "stepper_c: position_endstop: %.6f angle: %.6f\n"
             "radius: %.6f\n"
+            "(%s)\n"
             "To use these parameters, update the printer config file with\n"
             "the above and then issue a RESTART command" % (
                 new_params['endstop_a'], new_params['angle_a'],
                 new_params['endstop_b'], new_params['angle_b'],
                 new_params['endstop_c'], new_params['angle_c'],
-                new_params['radius']))
+                new_params['radius'],
+                mathutil.format_residuals(new_residuals)))
 
 def load_config(config):
     return DeltaCalibrate(config)
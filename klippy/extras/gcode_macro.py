@@ -10,6 +10,7 @@ class GCodeMacro:
         self.script = config.get('gcode')
         printer = config.get_printer()
         self.gcode = printer.lookup_object('gcode')
+        self.compiled_script = self.gcode.compile_script(self.script)
         try:
             self.gcode.register_command(self.alias, self.cmd, desc=self.cmd_desc)
         except self.gcode.error as e:
@@ -21,7 +22,7 @@ class GCodeMacro:
             raise self.gcode.error("Macro %s called recursively" % (self.alias,))
         self.in_script = True
         try:
-            self.gcode.run_script(self.script)
+            self.gcode.run_compiled_script(self.compiled_script)
         finally:
             self.in_script = False
 
@@ -13,6 +13,7 @@ class HomingOverride:
         self.script = config.get('gcode')
         self.in_script = False
         self.gcode = self.printer.lookup_object('gcode')
+        self.compiled_script = self.gcode.compile_script(self.script)
         self.gcode.register_command("G28", None)
         self.gcode.register_command("G28", self.cmd_G28)
     def cmd_G28(self, params):
@@ -54,7 +55,7 @@ class HomingOverride:
         # Perform homing
         try:
             self.in_script = True
-            self.gcode.run_script(self.script)
+            self.gcode.run_compiled_script(self.compiled_script)
         finally:
             self.in_script = False
 
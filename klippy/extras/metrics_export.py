@@ -0,0 +1,40 @@
+# Periodically export the metrics registry in Prometheus text format
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, logging
+
+class MetricsExport:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.metrics = self.printer.lookup_object('metrics')
+        self.filename = os.path.expanduser(
+            config.get('path', '/tmp/klippy_metrics.prom'))
+        self.interval = config.getfloat('interval', 5., minval=0.100)
+        self.export_timer = self.reactor.register_timer(self.export_event)
+    def printer_state(self, state):
+        if state == 'ready':
+            self.reactor.update_timer(self.export_timer, self.reactor.NOW)
+        elif state == 'shutdown':
+            self.export_event(self.reactor.monotonic())
+        elif state == 'disconnect':
+            self.reactor.update_timer(self.export_timer, self.reactor.NEVER)
+    def export_event(self, eventtime):
+        data = self.metrics.export_text(eventtime)
+        # Write to a temporary file and rename so readers never see a
+        # partially written file
+        tmpname = self.filename + ".tmp"
+        try:
+            f = open(tmpname, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError):
+            logging.exception("Unable to write metrics file %s",
+                              self.filename)
+        return eventtime + self.interval
+
+def load_config(config):
+    return MetricsExport(config)
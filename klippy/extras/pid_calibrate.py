@@ -13,6 +13,7 @@ class PIDCalibrate:
         self.gcode.register_command(
             'PID_CALIBRATE', self.cmd_PID_CALIBRATE,
             desc=self.cmd_PID_CALIBRATE_help)
+    # Also listed in DEFERRED_MODULES in klippy.py
     cmd_PID_CALIBRATE_help = "Run PID calibration test"
     def cmd_PID_CALIBRATE(self, params):
         heater_name = self.gcode.get_str('HEATER', params)
@@ -3,7 +3,8 @@
 # Copyright (C) 2017-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import pins, homing
+import logging
+import pins, homing, mathutil
 
 HINT_TIMEOUT = """
 Make sure to home the printer before probing. If the probe
@@ -17,6 +18,12 @@ class PrinterProbe:
         self.printer = config.get_printer()
         self.speed = config.getfloat('speed', 5.0)
         self.z_offset = config.getfloat('z_offset')
+        self.samples = config.getint('samples', 1, minval=1)
+        self.sample_retract_dist = config.getfloat(
+            'sample_retract_dist', 2., above=0.)
+        self.samples_result = config.getchoice(
+            'samples_result', {'median': 'median',
+                               'trimmed_mean': 'trimmed_mean'}, 'median')
         # Infer Z position to move to during a probe
         if config.has_section('stepper_z'):
             zconfig = config.getsection('stepper_z')
@@ -62,8 +69,7 @@ class PrinterProbe:
         if self.z_virtual_endstop is None:
             return None
         return self.z_virtual_endstop.position
-    cmd_PROBE_help = "Probe Z-height at current XY position"
-    def cmd_PROBE(self, params):
+    def probe_once(self):
         toolhead = self.printer.lookup_object('toolhead')
         homing_state = homing.Homing(toolhead)
         pos = toolhead.get_position()
@@ -76,10 +82,55 @@ class PrinterProbe:
             if "Timeout during endstop homing" in reason:
                 reason += HINT_TIMEOUT
             raise self.gcode.error(reason)
-        kin = toolhead.get_kinematics()
-        pos = kin.get_position()
-        self.gcode.respond_info(
-            "probe z: %.3f" % (pos[2]))
+    def calc_probe_result(self, positions):
+        # Combine the samples one coordinate at a time
+        count = len(positions)
+        result = []
+        for coords in zip(*positions):
+            coords = sorted(coords)
+            if self.samples_result == 'median':
+                mid = count // 2
+                if count & 1:
+                    result.append(coords[mid])
+                else:
+                    result.append(.5 * (coords[mid-1] + coords[mid]))
+            else:
+                # Discard the highest and lowest sample (if possible)
+                if count >= 3:
+                    coords = coords[1:-1]
+                result.append(sum(coords) / float(len(coords)))
+        return result
+    def run_probe(self, get_position=None):
+        # Probe the current XY position 'samples' times, lifting the
+        # head by sample_retract_dist between each attempt.  Returns
+        # the combined result of get_position() and the sample range.
+        toolhead = self.printer.lookup_object('toolhead')
+        if get_position is None:
+            get_position = toolhead.get_kinematics().get_position
+        positions = []
+        while 1:
+            self.probe_once()
+            positions.append(list(get_position()))
+            if len(positions) >= self.samples:
+                break
+            curpos = toolhead.get_position()
+            curpos[2] += self.sample_retract_dist
+            try:
+                toolhead.move(curpos, self.speed)
+            except homing.EndstopError as e:
+                raise self.gcode.error(str(e))
+        z_positions = [pos[2] for pos in positions]
+        return (self.calc_probe_result(positions),
+                max(z_positions) - min(z_positions))
+    cmd_PROBE_help = "Probe Z-height at current XY position"
+    def cmd_PROBE(self, params):
+        pos, sample_range = self.run_probe()
+        if self.samples > 1:
+            self.gcode.respond_info(
+                "probe z: %.3f (%s of %d samples, range %.3f)" % (
+                    pos[2], self.samples_result, self.samples, sample_range))
+        else:
+            self.gcode.respond_info("probe z: %.3f" % (pos[2],))
         self.gcode.reset_last_position()
     cmd_QUERY_PROBE_help = "Return the status of the z-probe"
     def cmd_QUERY_PROBE(self, params):
@@ -173,6 +224,7 @@ class ProbePointsHelper:
         self.results = []
         self.busy = False
         self.gcode = self.toolhead = None
+        self.start_time = self.max_sample_range = 0.
     def get_lift_speed(self):
         return self.lift_speed
     def start_probe(self):
@@ -186,12 +238,31 @@ class ProbePointsHelper:
         self.move_next()
         if self.probe is not None:
             try:
-                while self.busy:
-                    self.gcode.run_script("PROBE")
-                    self.cmd_NEXT({})
+                self.run_automatic()
             except:
                 self.finalize(False)
                 raise
+    def run_automatic(self):
+        # Probe all points without waiting for the toolhead to stop
+        # between them - the lift and travel to the next point are
+        # queued behind each probe and only flushed by the next
+        # probe's homing move.
+        self.start_time = self.printer.get_reactor().monotonic()
+        self.max_sample_range = 0.
+        while self.busy:
+            pos, sample_range = self.probe.run_probe(
+                self.callback.get_position)
+            self.max_sample_range = max(self.max_sample_range, sample_range)
+            self.record_position(pos)
+    def report_probe_time(self):
+        msg = "Probed %d points in %.2fs" % (
+            len(self.results),
+            self.printer.get_reactor().monotonic() - self.start_time)
+        if self.probe.samples > 1:
+            msg += " (%d samples per point, max range %.3f)" % (
+                self.probe.samples, self.max_sample_range)
+        logging.info(msg)
+        self.gcode.respond_info(msg)
     def move_next(self):
         x, y = self.probe_points[len(self.results)]
         curpos = self.toolhead.get_position()
@@ -208,7 +279,9 @@ class ProbePointsHelper:
     def cmd_NEXT(self, params):
         # Record current position
         self.toolhead.wait_moves()
-        self.results.append(self.callback.get_position())
+        self.record_position(self.callback.get_position())
+    def record_position(self, pos):
+        self.results.append(pos)
         # Lift toolhead
         curpos = self.toolhead.get_position()
         curpos[2] = self.horizontal_move_z
@@ -220,9 +293,27 @@ class ProbePointsHelper:
         # Move to next position
         if len(self.results) == len(self.probe_points):
             self.toolhead.get_last_move_time()
+            if self.probe is not None:
+                self.report_probe_time()
             self.finalize(True)
             return
         self.move_next()
+    def calc_least_squares(self, adj_params, params, residual_func):
+        # Fit the probed positions without stalling the reactor
+        progress = {'rounds': 0, 'error': 0.}
+        def report(elapsed):
+            self.gcode.respond_info(
+                "Calculating: round %d error %.9f (%.1fs elapsed)" % (
+                    progress['rounds'], progress['error'], elapsed))
+        reactor = self.printer.get_reactor()
+        (new_params, residuals), elapsed = mathutil.background_call(
+            reactor, mathutil.least_squares,
+            (adj_params, params, residual_func, 200, progress), report)
+        logging.info("Calibration calculation took %.3fs (%d rounds)",
+                     elapsed, progress['rounds'])
+        self.gcode.respond_info("Calculation took %.3fs (%d rounds)" % (
+            elapsed, progress['rounds']))
+        return new_params, residuals
     def finalize(self, success):
         self.busy = False
         self.gcode.reset_last_position()
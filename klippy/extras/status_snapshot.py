@@ -0,0 +1,181 @@
+# Periodically write a binary status snapshot to a memory mapped file
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, mmap, struct, logging
+
+# The file consists of a header followed by a fixed number of heater
+# records and then a fixed number of mcu records (all values little
+# endian):
+#   header: magic "KLSS", version (uint32), sequence (uint32),
+#           heater count (uint32), eventtime (double), printer state
+#           (uint32: 0=startup 1=ready 2=shutdown), toolhead status
+#           (uint32: 0=idle 1=ready 2=printing), print_stall (uint32),
+#           mcu count (uint32), print_time, buffer_time, printing_time,
+#           X, Y, Z, E position, sd progress, speed factor (doubles)
+#   heater: name (16 byte nul padded), temperature, target (doubles)
+#   mcu: name (16 byte nul padded), followed by a double for each of
+#        the MCU_METRICS below (0. if the mcu does not report it)
+# The mcu values are taken from the metrics registry (see the
+# "metrics_export" section of config/example-extras.cfg for their
+# descriptions).
+# The sequence number is odd while the snapshot is being updated.  A
+# reader should read the sequence, copy the data, and then retry if
+# the sequence was odd or has since changed (see read_snapshot()).
+SNAPSHOT_MAGIC = "KLSS"
+SNAPSHOT_VERSION = 2
+MCU_METRICS = [
+    'mcu_awake', 'mcu_task_avg', 'mcu_task_stddev',
+    'serial_bytes_write_total', 'serial_bytes_read_total',
+    'serial_bytes_retransmit_total', 'serial_bytes_invalid_total',
+    'serial_send_seq_total', 'serial_receive_seq_total',
+    'serial_srtt', 'serial_rto', 'serial_ready_bytes',
+    'serial_stalled_bytes', 'clock_freq', 'clock_adj_freq']
+HEADER_FORMAT = "<4sIIIdIIII9d"
+HEATER_FORMAT = "<16sdd"
+MCU_FORMAT = "<16s%dd" % (len(MCU_METRICS),)
+MAX_HEATERS = 8
+MAX_MCUS = 4
+SEQUENCE_OFFSET = 8
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEATER_SIZE = struct.calcsize(HEATER_FORMAT)
+MCU_SIZE = struct.calcsize(MCU_FORMAT)
+MCU_OFFSET = HEADER_SIZE + MAX_HEATERS * HEATER_SIZE
+SNAPSHOT_SIZE = MCU_OFFSET + MAX_MCUS * MCU_SIZE
+
+PRINTER_STATES = {'startup': 0, 'ready': 1, 'shutdown': 2}
+TOOLHEAD_STATES = {'Idle': 0, 'Ready': 1, 'Printing': 2}
+
+# Decode a snapshot (as produced by StatusSnapshot) into a dictionary
+def decode_snapshot(data):
+    hdr = struct.unpack_from(HEADER_FORMAT, data)
+    if hdr[0] != SNAPSHOT_MAGIC or hdr[1] != SNAPSHOT_VERSION:
+        raise ValueError("Not a status snapshot file")
+    res = {'sequence': hdr[2], 'eventtime': hdr[4], 'printer_state': hdr[5],
+           'toolhead_state': hdr[6], 'print_stall': hdr[7],
+           'print_time': hdr[9], 'buffer_time': hdr[10],
+           'printing_time': hdr[11], 'position': list(hdr[12:16]),
+           'progress': hdr[16], 'speed_factor': hdr[17], 'heaters': {},
+           'mcus': {}}
+    for i in range(min(hdr[3], MAX_HEATERS)):
+        name, temp, target = struct.unpack_from(
+            HEATER_FORMAT, data, HEADER_SIZE + i * HEATER_SIZE)
+        res['heaters'][name.rstrip('\0')] = (temp, target)
+    for i in range(min(hdr[8], MAX_MCUS)):
+        vals = struct.unpack_from(MCU_FORMAT, data, MCU_OFFSET + i * MCU_SIZE)
+        res['mcus'][vals[0].rstrip('\0')] = dict(zip(MCU_METRICS, vals[1:]))
+    return res
+
+# Open a snapshot file for reading (returns a read-only memory map)
+def open_snapshot(filename):
+    f = open(filename, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), SNAPSHOT_SIZE, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+# Read a consistent snapshot from a map returned by open_snapshot()
+def read_snapshot(mm, retries=100):
+    for i in range(retries):
+        data = mm[:SNAPSHOT_SIZE]
+        hdr = data[:SEQUENCE_OFFSET + 4]
+        seq = struct.unpack_from("<I", hdr, SEQUENCE_OFFSET)[0]
+        if not seq & 1 and mm[:SEQUENCE_OFFSET + 4] == hdr:
+            return decode_snapshot(data)
+    raise IOError("Unable to obtain a consistent status snapshot")
+
+class StatusSnapshot:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.filename = os.path.expanduser(
+            config.get('path', '/tmp/klippy_status'))
+        self.interval = config.getfloat('interval', 0.500, minval=0.050)
+        self.mmap = None
+        self.sequence = 0
+        self.printer_state_code = PRINTER_STATES['startup']
+        self.toolhead = self.gcode = self.sdcard = self.metrics = None
+        self.heaters = []
+        self.update_timer = self.reactor.register_timer(self.update_event)
+    def printer_state(self, state):
+        if state == 'ready':
+            self.toolhead = self.printer.lookup_object('toolhead')
+            self.gcode = self.printer.lookup_object('gcode')
+            self.sdcard = self.printer.lookup_object('virtual_sdcard', None)
+            self.metrics = self.printer.lookup_object('metrics')
+            pheater = self.printer.lookup_object('heater')
+            heaters = sorted(pheater.heaters.items())
+            if len(heaters) > MAX_HEATERS:
+                logging.info("status_snapshot: only reporting %d heaters",
+                             MAX_HEATERS)
+            self.heaters = heaters[:MAX_HEATERS]
+            self.open_file()
+            self.printer_state_code = PRINTER_STATES['ready']
+            self.reactor.update_timer(self.update_timer, self.reactor.NOW)
+        elif state == 'shutdown':
+            self.printer_state_code = PRINTER_STATES['shutdown']
+            if self.mmap is not None:
+                self.update_event(self.reactor.monotonic())
+        elif state == 'disconnect':
+            self.reactor.update_timer(self.update_timer, self.reactor.NEVER)
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+    def open_file(self):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(fd, SNAPSHOT_SIZE)
+            self.mmap = mmap.mmap(fd, SNAPSHOT_SIZE)
+        finally:
+            os.close(fd)
+        # Continue the sequence of any previous writer of the file
+        seq = struct.unpack_from("<I", self.mmap, SEQUENCE_OFFSET)[0]
+        self.sequence = (seq + 1) & ~1
+    def get_mcu_metrics(self, eventtime):
+        # Return {mcu_name: {metric: value}} from the metrics registry
+        mcus = {}
+        for name, mtype, desc, samples in self.metrics.collect(eventtime):
+            for labels, value in samples:
+                labels = dict(labels)
+                if 'mcu' in labels:
+                    mcus.setdefault(labels['mcu'], {})[name] = value
+        return mcus
+    def build_snapshot(self, eventtime):
+        th = self.toolhead.get_status(eventtime)
+        gc = self.gcode.get_status(eventtime)
+        progress = 0.
+        if self.sdcard is not None:
+            progress = self.sdcard.get_status(eventtime)['progress']
+        mcus = self.get_mcu_metrics(eventtime)
+        mcu_names = sorted(mcus)[:MAX_MCUS]
+        data = [struct.pack(
+            HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.sequence,
+            len(self.heaters), eventtime, self.printer_state_code,
+            TOOLHEAD_STATES.get(th['status'], 0), th['print_stall'],
+            len(mcu_names), th['print_time'], th['buffer_time'],
+            th['printing_time'],
+            *(th['position'] + [progress, gc['speed_factor']]))]
+        for name, heater in self.heaters:
+            hs = heater.get_status(eventtime)
+            data.append(struct.pack(HEATER_FORMAT, name[:16],
+                                    hs['temperature'], hs['target']))
+        data.append("\0" * ((MAX_HEATERS - len(self.heaters)) * HEATER_SIZE))
+        for name in mcu_names:
+            values = mcus[name]
+            data.append(struct.pack(MCU_FORMAT, name[:16], *[
+                float(values.get(m, 0.)) for m in MCU_METRICS]))
+        return "".join(data)
+    def update_event(self, eventtime):
+        data = self.build_snapshot(eventtime)
+        mm = self.mmap
+        # Mark the snapshot as being updated, copy, and then mark complete
+        struct.pack_into("<I", mm, SEQUENCE_OFFSET, self.sequence + 1)
+        mm[SEQUENCE_OFFSET + 4:len(data)] = data[SEQUENCE_OFFSET + 4:]
+        mm[:SEQUENCE_OFFSET] = data[:SEQUENCE_OFFSET]
+        self.sequence = (self.sequence + 2) & 0xfffffffe
+        struct.pack_into("<I", mm, SEQUENCE_OFFSET, self.sequence)
+        return eventtime + self.interval
+
+def load_config(config):
+    return StatusSnapshot(config)
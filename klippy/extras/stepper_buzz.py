@@ -12,7 +12,9 @@ class StepperBuzz:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.steppers = {}
-        # Setup iterative solver
+        # The iterative solver is setup on first use of STEPPER_BUZZ
+        self.cmove = self.move_fill = self.stepper_kinematics = None
+    def setup_itersolve(self):
         ffi_main, ffi_lib = chelper.get_ffi()
         self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
         self.move_fill = ffi_lib.move_fill
@@ -35,6 +37,8 @@ class StepperBuzz:
         name = self.gcode.get_str('STEPPER', params)
         logging.info("Stepper buzz %s", name)
         stepper = self.steppers[name]
+        if self.cmove is None:
+            self.setup_itersolve()
         need_motor_enable = stepper.need_motor_enable
         # Move stepper
         toolhead = self.printer.lookup_object('toolhead')
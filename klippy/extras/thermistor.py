@@ -9,6 +9,35 @@ KELVIN_TO_CELCIUS = -273.15
 SAMPLE_TIME = 0.001
 SAMPLE_COUNT = 8
 REPORT_TIME = 0.300
+LOOKUP_TABLE_MAX_SIZE = 16384
+
+# Table of function values over a range with linear interpolation
+# between entries.  The table size is doubled until the interpolation
+# error at the middle of every interval is no more than max_error.
+class LookupTable:
+    def __init__(self, func, minval, maxval, size, max_error):
+        while 1:
+            step = (maxval - minval) / size
+            values = [func(minval + i * step) for i in range(size + 1)]
+            error = max([abs(func(minval + (i + .5) * step)
+                             - .5 * (values[i] + values[i+1]))
+                         for i in range(size)])
+            if error <= max_error or size >= LOOKUP_TABLE_MAX_SIZE:
+                break
+            size *= 2
+        self.minval = minval
+        self.inv_step = 1. / step
+        self.size = size
+        self.values = values
+        self.error = error
+    def lookup(self, val):
+        pos = (val - self.minval) * self.inv_step
+        i = int(pos)
+        if pos < 0. or i >= self.size:
+            return None
+        values = self.values
+        v = values[i]
+        return v + (values[i+1] - v) * (pos - i)
 
 # Analog voltage to temperature converter for thermistors
 class Thermistor:
@@ -19,6 +48,10 @@ class Thermistor:
         self.mcu_adc = ppins.setup_pin('adc', config.get('sensor_pin'))
         self.mcu_adc.setup_adc_callback(REPORT_TIME, self.adc_callback)
         self.temperature_callback = None
+        self.table_size = config.getint('lookup_table_size', 256, minval=0)
+        self.table_max_error = config.getfloat(
+            'lookup_table_max_error', 0.01, above=0.)
+        self.table = None
         self.c1 = self.c2 = self.c3 = 0.
         if 'beta' in params:
             self.calc_coefficients_beta(params, params['beta'])
@@ -60,18 +93,32 @@ class Thermistor:
         adc_range = [self.calc_adc(min_temp), self.calc_adc(max_temp)]
         self.mcu_adc.setup_minmax(SAMPLE_TIME, SAMPLE_COUNT,
                                   minval=min(adc_range), maxval=max(adc_range))
+        if self.table_size:
+            # Only valid readings need to be covered by the lookup table
+            self.table = LookupTable(self.calc_temp, min(adc_range),
+                                     max(adc_range), self.table_size,
+                                     self.table_max_error)
+            logging.info("Thermistor %s lookup table: %d entries"
+                         " (max error %.6f)", self.name, self.table.size + 1,
+                         self.table.error)
     def setup_callback(self, temperature_callback):
         self.temperature_callback = temperature_callback
     def get_report_time_delta(self):
         return REPORT_TIME
     def adc_callback(self, read_time, read_value):
+        temp = None
+        if self.table is not None:
+            temp = self.table.lookup(read_value)
+        if temp is None:
+            temp = self.calc_temp(read_value)
+        self.temperature_callback(read_time + SAMPLE_COUNT * SAMPLE_TIME, temp)
+    def calc_temp(self, adc):
         # Calculate temperature from adc
-        adc = max(.00001, min(.99999, read_value))
+        adc = max(.00001, min(.99999, adc))
         r = self.pullup * adc / (1.0 - adc)
         ln_r = math.log(r)
         inv_t = self.c1 + self.c2 * ln_r + self.c3 * ln_r**3
-        temp = 1.0/inv_t + KELVIN_TO_CELCIUS
-        self.temperature_callback(read_time + SAMPLE_COUNT * SAMPLE_TIME, temp)
+        return 1.0/inv_t + KELVIN_TO_CELCIUS
     def calc_adc(self, temp):
         inv_t = 1. / (temp - KELVIN_TO_CELCIUS)
         if self.c3:
@@ -0,0 +1,176 @@
+# Record host scheduling activity and export it as Chrome trace events
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, json, logging, threading, collections
+
+SERIAL_SAMPLE_TIME = 0.010
+REACTOR_TID = 1
+SERIAL_TID = 2
+
+# Return a descriptive name for a timer callback
+def callback_name(callback):
+    obj = getattr(callback, '__self__', None)
+    name = getattr(callback, '__name__', str(callback))
+    if obj is None:
+        return name
+    return "%s.%s" % (obj.__class__.__name__, name)
+
+# Events are stored in a fixed size ring buffer as tuples of either
+# ('X', name, start_time, end_time) for a timed section or
+# ('C', name, time, values) for a set of counter values.  Nothing is
+# recorded (and nothing is wrapped) while the recorder is disabled.
+class TraceRecorder:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.filename = os.path.expanduser(
+            config.get('path', '/tmp/klippy_trace.json'))
+        self.size = config.getint('size', 100000, minval=100)
+        self.dump_on_shutdown = config.getboolean('dump_on_shutdown', True)
+        self.events = collections.deque(maxlen=self.size)
+        self.is_enabled = False
+        self.wrapped = []
+        self.serial_last = {}
+        self.sample_timer = self.reactor.register_timer(self.sample_serial)
+        # Register commands
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command('TRACE_START', self.cmd_TRACE_START,
+                                    desc=self.cmd_TRACE_START_help)
+        self.gcode.register_command('TRACE_STOP', self.cmd_TRACE_STOP,
+                                    desc=self.cmd_TRACE_STOP_help)
+        self.gcode.register_command('TRACE_DUMP', self.cmd_TRACE_DUMP,
+                                    desc=self.cmd_TRACE_DUMP_help)
+    def printer_state(self, state):
+        if state == 'shutdown':
+            if self.is_enabled:
+                self.stop()
+                if self.dump_on_shutdown:
+                    self.dump(self.filename)
+        elif state == 'disconnect':
+            self.stop()
+    # Instrumentation
+    def wrap_timer(self, callback):
+        if callback == self.sample_serial:
+            return callback
+        name = callback_name(callback)
+        events = self.events
+        monotonic = self.reactor.monotonic
+        def timer_wrapper(eventtime):
+            start = monotonic()
+            try:
+                return callback(eventtime)
+            finally:
+                events.append(('X', name, start, monotonic()))
+        return timer_wrapper
+    def wrap_method(self, obj, method, name):
+        func = getattr(obj, method)
+        events = self.events
+        monotonic = self.reactor.monotonic
+        def method_wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                events.append(('X', name, start, monotonic()))
+        setattr(obj, method, method_wrapper)
+        self.wrapped.append((obj, method))
+    def start(self):
+        if self.is_enabled:
+            return
+        self.is_enabled = True
+        toolhead = self.printer.lookup_object('toolhead')
+        self.wrap_method(toolhead.move_queue, 'flush', "MoveQueue.flush")
+        for m in self.printer.lookup_module_objects('mcu'):
+            self.wrap_method(m, 'flush_moves',
+                             "steppersync_flush %s" % (m.get_name(),))
+        self.reactor.set_timer_wrapper(self.wrap_timer)
+        self.serial_last = {}
+        self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
+    def stop(self):
+        if not self.is_enabled:
+            return
+        self.is_enabled = False
+        self.reactor.update_timer(self.sample_timer, self.reactor.NEVER)
+        self.reactor.set_timer_wrapper(None)
+        for obj, method in self.wrapped:
+            # Remove the instance attribute to restore the class method
+            delattr(obj, method)
+        self.wrapped = []
+    def sample_serial(self, eventtime):
+        # The serialqueue transmits from a background thread, so
+        # record its byte counters to show when bursts were sent
+        for m in self.printer.lookup_module_objects('mcu'):
+            name = m.get_name()
+            stats = m.get_serial().get_metrics(eventtime)
+            if not stats:
+                continue
+            bytes_write = stats['serial_bytes_write_total']
+            last = self.serial_last.get(name, bytes_write)
+            self.serial_last[name] = bytes_write
+            self.events.append(('C', "serial %s" % (name,), eventtime, {
+                'bytes_sent': bytes_write - last,
+                'ready_bytes': stats['serial_ready_bytes'],
+                'stalled_bytes': stats['serial_stalled_bytes']}))
+        return eventtime + SERIAL_SAMPLE_TIME
+    # Export
+    def build_trace(self, events):
+        out = []
+        for event in events:
+            if event[0] == 'X':
+                ph, name, start, end = event
+                out.append({'name': name, 'ph': 'X', 'pid': 1,
+                            'tid': REACTOR_TID, 'ts': start * 1000000.,
+                            'dur': (end - start) * 1000000.})
+            else:
+                ph, name, eventtime, values = event
+                out.append({'name': name, 'ph': 'C', 'pid': 1,
+                            'tid': SERIAL_TID, 'ts': eventtime * 1000000.,
+                            'args': values})
+        out.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                    'tid': REACTOR_TID, 'args': {'name': "reactor"}})
+        out.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                    'tid': SERIAL_TID, 'args': {'name': "serialqueue"}})
+        return {'traceEvents': out, 'displayTimeUnit': 'ms'}
+    def write_trace(self, filename, events):
+        try:
+            f = open(filename, 'wb')
+            json.dump(self.build_trace(events), f, separators=(',', ':'))
+            f.close()
+        except (IOError, OSError):
+            logging.exception("Unable to write trace file %s", filename)
+            return
+        logging.info("Wrote %d trace events to %s", len(events), filename)
+    def dump(self, filename):
+        # Conversion to json is done in a background thread so that
+        # large traces do not stall the reactor
+        events = list(self.events)
+        t = threading.Thread(target=self.write_trace, args=(filename, events))
+        t.start()
+        return len(events)
+    # G-Code commands
+    cmd_TRACE_START_help = "Start recording host scheduling trace events"
+    def cmd_TRACE_START(self, params):
+        size = self.gcode.get_int('SIZE', params, self.size, minval=100)
+        self.stop()
+        self.events.clear()
+        if size != self.events.maxlen:
+            self.events = collections.deque(maxlen=size)
+        self.start()
+        self.gcode.respond_info("Tracing started (%d events)" % (size,))
+    cmd_TRACE_STOP_help = "Stop recording host scheduling trace events"
+    def cmd_TRACE_STOP(self, params):
+        self.stop()
+        self.gcode.respond_info("Tracing stopped (%d events recorded)" % (
+            len(self.events),))
+    cmd_TRACE_DUMP_help = "Write recorded trace events to a file"
+    def cmd_TRACE_DUMP(self, params):
+        filename = os.path.expanduser(
+            params.get('FILENAME', self.filename))
+        count = self.dump(filename)
+        self.gcode.respond_info("Writing %d trace events to %s" % (
+            count, filename))
+
+def load_config(config):
+    return TraceRecorder(config)
@@ -17,6 +17,12 @@ class VirtualSD:
         self.reactor = printer.get_reactor()
         self.must_pause_work = False
         self.work_timer = None
+        # Metrics
+        metrics = printer.lookup_object('metrics')
+        metrics.register_group(self.get_metrics, [
+            ('sd_file_position', 'gauge', "Position in the current file"),
+            ('sd_file_size', 'gauge', "Size of the current file"),
+            ('sd_printing', 'gauge', "Set to 1 while printing a file")])
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         self.gcode.register_command('M21', None)
@@ -42,6 +48,10 @@ class VirtualSD:
         if self.work_timer is None:
             return False, ""
         return True, "sd_pos=%d" % (self.file_position,)
+    def get_metrics(self, eventtime):
+        return {'sd_file_position': self.file_position,
+                'sd_file_size': self.file_size,
+                'sd_printing': self.work_timer is not None}
     def get_file_list(self):
         dname = self.sdcard_dirname
         try:
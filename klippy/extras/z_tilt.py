@@ -55,14 +55,13 @@ class ZTilt:
             x, y, z = pos
             return (z - x*params['x_adjust'] - y*params['y_adjust']
                     - params['z_adjust'])
-        def errorfunc(params):
-            total_error = 0.
-            for pos in positions:
-                total_error += adjusted_height(pos, params)**2
-            return total_error
-        new_params = mathutil.coordinate_descent(
-            params.keys(), params, errorfunc)
+        def residuals(params):
+            return [adjusted_height(pos, params) for pos in positions]
+        new_params, new_residuals = self.probe_helper.calc_least_squares(
+            params.keys(), params, residuals)
         logging.info("Calculated bed tilt parameters: %s", new_params)
+        self.gcode.respond_info("Probed points fit with %s" % (
+            mathutil.format_residuals(new_residuals),))
         try:
             self.adjust_steppers(new_params['x_adjust'], new_params['y_adjust'],
                                  new_params['z_adjust'], z_offset)
@@ -9,10 +9,32 @@ import homing, extruder
 class error(Exception):
     pass
 
+# Bounded least-recently-used cache of parsed command lines
+class ParseCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = value
+        return value
+    def add(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
 # Parse and handle G-Code commands
 class GCodeParser:
     error = error
     RETRY_TIME = 0.100
+    PARSE_CACHE_SIZE = 256
+    MAX_PENDING_COMMANDS = 20
+    MAX_STREAM_WINDOW = 256
     def __init__(self, printer, fd):
         self.printer = printer
         self.fd = fd
@@ -27,12 +49,26 @@ class GCodeParser:
         self.pending_commands = []
         self.bytes_read = 0
         self.input_log = collections.deque([], 50)
+        # Output buffering (responses are coalesced into one write)
+        self.output_buffer = []
+        self.output_timer = self.reactor.register_timer(self.flush_event)
+        self.output_writes = self.output_writes_saved = 0
+        # Streaming mode (line numbered input with a window of lines
+        # in flight and batched acknowledgements)
+        self.stream_window = 0
+        self.stream_line = None
+        self.stream_next_line = self.stream_acked_line = 0
+        self.stream_ack_pending = False
+        self.output_capture = None
+        self.max_pending = self.MAX_PENDING_COMMANDS
         # Command handling
         self.is_printer_ready = False
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
         self.gcode_help = {}
+        self.script_cache = ParseCache(self.PARSE_CACHE_SIZE)
+        self.extended_cache = ParseCache(self.PARSE_CACHE_SIZE)
         for cmd in self.all_handlers:
             func = getattr(self, 'cmd_' + cmd)
             wnr = getattr(self, 'cmd_' + cmd + '_when_not_ready', False)
@@ -93,11 +129,19 @@ class GCodeParser:
         self.move_with_transform = transform.move
         self.position_with_transform = transform.get_position
     def stats(self, eventtime):
-        return False, "gcodein=%d" % (self.bytes_read,)
+        hits = self.script_cache.hits + self.extended_cache.hits
+        misses = self.script_cache.misses + self.extended_cache.misses
+        return False, (
+            "gcodein=%d gcodeout_writes=%d gcodeout_writes_saved=%d"
+            " parse_cache_hits=%d parse_cache_misses=%d" % (
+                self.bytes_read, self.output_writes, self.output_writes_saved,
+                hits, misses))
     def get_status(self, eventtime):
         busy = self.is_processing_data
         return {'speed_factor': self.speed_factor * 60., 'busy': busy}
     def printer_state(self, state):
+        if state in ('shutdown', 'disconnect'):
+            self.flush_output()
         if state == 'shutdown':
             if not self.is_printer_ready:
                 return
@@ -143,43 +187,78 @@ class GCodeParser:
         logging.info("\n".join(out))
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    def parse_line(self, line):
+        # Ignore comments and leading/trailing spaces
+        line = origline = line.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        # Break command into parts
+        parts = self.args_r.split(line.upper())[1:]
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(0, len(parts), 2) }
+        params['#original'] = origline
+        if parts and parts[0] == 'N':
+            # Skip line number at start of command
+            del parts[:2]
+        if not parts:
+            # Treat empty line as empty command
+            parts = ['', '']
+        params['#command'] = parts[0] + parts[1].strip()
+        return params
+    def parse_line_cached(self, line):
+        params = self.script_cache.get(line)
+        if params is None:
+            params = self.parse_line(line)
+            self.script_cache.add(line, params)
+        # Handlers receive a private copy of the parameters
+        return dict(params)
+    def process_command(self, params, need_ack=True):
+        # Invoke handler for command
+        cmd = params['#command']
+        self.need_ack = need_ack
+        handler = self.gcode_handlers.get(cmd, self.cmd_default)
+        try:
+            handler(params)
+        except error as e:
+            self.respond_error(str(e))
+            self.reset_last_position()
+            if not need_ack:
+                raise
+        except:
+            msg = 'Internal error on command:"%s"' % (cmd,)
+            logging.exception(msg)
+            self.printer.invoke_shutdown(msg)
+            self.respond_error(msg)
+            if not need_ack:
+                raise
+        self.ack()
     def process_commands(self, commands, need_ack=True):
         for line in commands:
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line.upper())[1:]
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(0, len(parts), 2) }
-            params['#original'] = origline
-            if parts and parts[0] == 'N':
-                # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                # Treat empty line as empty command
-                parts = ['', '']
-            params['#command'] = cmd = parts[0] + parts[1].strip()
-            # Invoke handler for command
-            self.need_ack = need_ack
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
-            try:
-                handler(params)
-            except error as e:
-                self.respond_error(str(e))
-                self.reset_last_position()
-                if not need_ack:
-                    raise
-            except:
-                msg = 'Internal error on command:"%s"' % (cmd,)
-                logging.exception(msg)
-                self.printer.invoke_shutdown(msg)
-                self.respond_error(msg)
-                if not need_ack:
-                    raise
-            self.ack()
+            params = self.parse_line(line)
+            if self.stream_window and need_ack:
+                if not self.check_stream_line(params):
+                    continue
+            self.process_command(params, need_ack)
+    def check_stream_line(self, params):
+        # Verify the line number of a command received in streaming mode
+        if not params['#command'] and 'N' not in params:
+            # Blank lines do not consume a line number
+            return False
+        try:
+            line = int(params.get('N'))
+        except (TypeError, ValueError):
+            line = None
+        expected = self.stream_next_line
+        if line != expected:
+            self.stream_line = None
+            self.respond_error(
+                "Line number %s out of sequence (expected N%d)" % (
+                    params.get('N', "missing"), expected))
+            return False
+        self.stream_line = line
+        self.stream_next_line = line + 1
+        return True
     m112_r = re.compile('^(?:[nN][0-9]+)?\s*[mM]112(?:\s|$)')
     def process_data(self, eventtime):
         # Read input, separate by newline, and add to pending_commands
@@ -198,13 +277,13 @@ class GCodeParser:
             pending_commands.append("")
         # Handle case where multiple commands pending
         if self.is_processing_data or len(pending_commands) > 1:
-            if len(pending_commands) < 20:
+            if len(pending_commands) < self.max_pending:
                 # Check for M112 out-of-order
                 for line in lines:
                     if self.m112_r.match(line) is not None:
                         self.cmd_M112({})
             if self.is_processing_data:
-                if len(pending_commands) >= 20:
+                if len(pending_commands) >= self.max_pending:
                     # Stop reading input
                     self.reactor.unregister_fd(self.fd_handle)
                     self.fd_handle = None
@@ -224,13 +303,16 @@ class GCodeParser:
             pending_commands = self.pending_commands
         if self.fd_handle is None:
             self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
-    def process_batch(self, command):
+    def process_batch(self, command, output=None):
+        # Responses to the command are also appended to the output list
         if self.is_processing_data:
             return False
         self.is_processing_data = True
+        self.output_capture = output
         try:
             self.process_commands([command], need_ack=False)
         finally:
+            self.output_capture = None
             if self.pending_commands:
                 self.process_pending()
             self.is_processing_data = False
@@ -238,22 +320,81 @@ class GCodeParser:
     def run_script(self, script):
         prev_need_ack = self.need_ack
         try:
-            self.process_commands(script.split('\n'), need_ack=False)
+            for line in script.split('\n'):
+                self.process_command(self.parse_line_cached(line),
+                                     need_ack=False)
+        finally:
+            self.need_ack = prev_need_ack
+    # Parse a script once so that it may be run many times without
+    # reparsing (empty lines and comment only lines are dropped)
+    def compile_script(self, script):
+        compiled = []
+        for line in script.split('\n'):
+            params = self.parse_line(line)
+            if params['#command']:
+                compiled.append(params)
+        return compiled
+    def run_compiled_script(self, compiled):
+        prev_need_ack = self.need_ack
+        try:
+            for params in compiled:
+                # Handlers receive a private copy of the parameters
+                self.process_command(dict(params), need_ack=False)
         finally:
             self.need_ack = prev_need_ack
     # Response handling
+    def write_output(self, msg, flush=False):
+        if self.stream_ack_pending:
+            # Acks of earlier lines are sent before any later output
+            self.queue_stream_ack()
+        self.output_buffer.append(msg)
+        if flush:
+            self.flush_output()
+        elif len(self.output_buffer) == 1:
+            # Flush at the start of the next reactor loop iteration
+            self.reactor.update_timer(self.output_timer, self.reactor.NOW)
+    def queue_stream_ack(self):
+        # A single ack reports all lines completed since the last one
+        self.stream_ack_pending = False
+        self.output_buffer.append("ok N%d\n" % (self.stream_acked_line,))
+    def flush_output(self):
+        if self.stream_ack_pending:
+            self.queue_stream_ack()
+        output_buffer = self.output_buffer
+        if not output_buffer:
+            return
+        self.output_buffer = []
+        self.output_writes += 1
+        self.output_writes_saved += len(output_buffer) - 1
+        os.write(self.fd, "".join(output_buffer))
+    def flush_event(self, eventtime):
+        self.flush_output()
+        return self.reactor.NEVER
     def ack(self, msg=None):
+        if msg and self.output_capture is not None:
+            self.output_capture.append(msg)
         if not self.need_ack or self.is_fileinput:
             return
+        self.need_ack = False
+        if self.stream_line is not None:
+            if msg:
+                self.write_output("%s\n" % (msg,))
+            self.stream_acked_line = self.stream_line
+            self.stream_line = None
+            if not self.stream_ack_pending:
+                self.stream_ack_pending = True
+                self.reactor.update_timer(self.output_timer, self.reactor.NOW)
+            return
         if msg:
-            os.write(self.fd, "ok %s\n" % (msg,))
+            self.write_output("ok %s\n" % (msg,))
         else:
-            os.write(self.fd, "ok\n")
-        self.need_ack = False
-    def respond(self, msg):
+            self.write_output("ok\n")
+    def respond(self, msg, flush=False):
+        if self.output_capture is not None:
+            self.output_capture.append(msg)
         if self.is_fileinput:
             return
-        os.write(self.fd, msg+"\n")
+        self.write_output(msg+"\n", flush)
     def respond_info(self, msg):
         logging.debug(msg)
         lines = [l.strip() for l in msg.strip().split('\n')]
@@ -263,7 +404,10 @@ class GCodeParser:
         lines = msg.strip().split('\n')
         if len(lines) > 1:
             self.respond_info("\n".join(lines))
-        self.respond('!! %s' % (lines[0].strip(),))
+        prefix = ""
+        if self.stream_line is not None:
+            prefix = "N%d: " % (self.stream_line,)
+        self.respond('!! %s%s' % (prefix, lines[0].strip()), flush=True)
         if self.is_fileinput:
             self.printer.request_exit('error_exit')
     # Parameter parsing helpers
@@ -311,13 +455,17 @@ class GCodeParser:
             # Not an "extended" command
             return params
         eargs = m.group('args')
-        try:
-            eparams = [earg.split('=', 1) for earg in eargs.split()]
-            eparams = { k.upper(): v for k, v in eparams }
-            eparams.update({k: params[k] for k in params if k.startswith('#')})
-            return eparams
-        except ValueError as e:
-            raise error("Malformed command '%s'" % (params['#original'],))
+        eparams = self.extended_cache.get(eargs)
+        if eparams is None:
+            try:
+                eparams = [earg.split('=', 1) for earg in eargs.split()]
+                eparams = { k.upper(): v for k, v in eparams }
+            except ValueError as e:
+                raise error("Malformed command '%s'" % (params['#original'],))
+            self.extended_cache.add(eargs, eparams)
+        eparams = dict(eparams)
+        eparams.update({k: params[k] for k in params if k.startswith('#')})
+        return eparams
     # Temperature wrappers
     def get_temp(self, eventtime):
         # Tn:XXX /YYY B:XXX /YYY
@@ -415,7 +563,8 @@ class GCodeParser:
         'SET_GCODE_OFFSET', 'M206',
         'M105', 'M104', 'M109', 'M140', 'M190', 'M106', 'M107',
         'M112', 'M115', 'IGNORE', 'QUERY_ENDSTOPS', 'GET_POSITION',
-        'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
+        'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP',
+        'STREAM_MODE']
     # G-Code movement commands
     cmd_G1_aliases = ['G0']
     def cmd_G1(self, params):
@@ -574,6 +723,7 @@ class GCodeParser:
     def cmd_M112(self, params):
         # Emergency Stop
         self.printer.invoke_shutdown("Shutdown due to M112 command")
+        self.flush_output()
     cmd_M115_when_not_ready = True
     def cmd_M115(self, params):
         # Get Firmware Version and Capabilities
@@ -656,6 +806,18 @@ class GCodeParser:
             self.respond_info(msg)
         else:
             self.respond_error(msg)
+    cmd_STREAM_MODE_when_not_ready = True
+    cmd_STREAM_MODE_help = "Enable line numbered streaming of commands"
+    def cmd_STREAM_MODE(self, params):
+        window = self.get_int('WINDOW', params, minval=0,
+                              maxval=self.MAX_STREAM_WINDOW)
+        line = self.get_int('LINE', params, 1, minval=0)
+        self.stream_window = window
+        self.stream_next_line = line
+        self.max_pending = max(self.MAX_PENDING_COMMANDS, window + 1)
+        if window:
+            self.respond_info("Streaming mode enabled (window %d, next line"
+                              " N%d)" % (window, line))
     cmd_HELP_when_not_ready = True
     def cmd_HELP(self, params):
         cmdhelp = []
@@ -54,6 +54,12 @@ class Heater:
         # pwm caching
         self.next_pwm_time = 0.
         self.last_pwm_value = 0.
+        # Metrics
+        metrics = printer.lookup_object('metrics')
+        metrics.register_group(self._get_metrics, [
+            ('heater_temperature', 'gauge', "Measured temperature (Celsius)"),
+            ('heater_target', 'gauge', "Target temperature (Celsius)"),
+            ('heater_pwm', 'gauge', "Heater pwm value")], heater=self.name)
         # Load additional modules
         printer.try_load_module(config, "verify_heater %s" % (self.name,))
         printer.try_load_module(config, "pid_calibrate")
@@ -108,6 +114,11 @@ class Heater:
         is_active = target_temp or last_temp > 50.
         return is_active, '%s: target=%.0f temp=%.1f pwm=%.3f' % (
             self.name, target_temp, last_temp, last_pwm_value)
+    def _get_metrics(self, eventtime):
+        with self.lock:
+            return {'heater_temperature': self.last_temp,
+                    'heater_target': self.target_temp,
+                    'heater_pwm': self.last_pwm_value}
     def get_status(self, eventtime):
         with self.lock:
             target_temp = self.target_temp
@@ -5,9 +5,9 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, optparse, logging, time, threading
-import collections, ConfigParser, importlib
+import collections, ConfigParser, importlib, hashlib, StringIO
 import util, reactor, queuelogger, msgproto
-import gcode, pins, heater, mcu, toolhead, extruder
+import gcode, pins, heater, mcu, toolhead, extruder, metrics
 
 message_ready = "Printer is ready"
 
@@ -115,6 +115,27 @@ class ConfigWrapper:
         return [self.getsection(s) for s in self.fileconfig.sections()
                 if s.startswith(prefix)]
 
+# The parsed config file is kept for the life of the process so that
+# a RESTART with an unchanged config does not need to parse it again
+class ConfigFileCache:
+    def __init__(self):
+        self.key = self.fileconfig = None
+    def read(self, filename):
+        try:
+            f = open(filename, 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            return None
+        key = (filename, hashlib.sha1(data).digest())
+        if key != self.key:
+            fileconfig = ConfigParser.RawConfigParser()
+            fileconfig.readfp(StringIO.StringIO(data), filename)
+            self.key, self.fileconfig = key, fileconfig
+        return self.fileconfig
+
+config_file_cache = ConfigFileCache()
+
 class ConfigLogger():
     def __init__(self, cfg, bglogger):
         self.lines = ["===== Config file ====="]
@@ -126,14 +147,50 @@ class ConfigLogger():
     def write(self, data):
         self.lines.append(data.strip())
 
+# Extras modules that only register G-Code commands (and that have no
+# config options or printer_state/stats callbacks) are not imported
+# until one of their commands is first used.  The descriptions are
+# shown by HELP until the module is loaded (the module's own help then
+# replaces them), so they must be kept in sync with the
+# cmd_<command>_help strings in the module.
+DEFERRED_MODULES = {
+    'pid_calibrate': {'PID_CALIBRATE': "Run PID calibration test"},
+}
+
+class DeferredModule:
+    def __init__(self, printer, config, section, commands):
+        self.printer = printer
+        self.config = config
+        self.section = section
+        self.commands = commands
+        self.gcode = printer.lookup_object('gcode')
+        for cmd, desc in commands.items():
+            self.gcode.register_command(cmd, self.cmd_deferred, desc=desc)
+    def cmd_deferred(self, params):
+        for cmd in self.commands:
+            self.gcode.register_command(cmd, None)
+        self.printer.load_deferred_module(self.config, self.section)
+        for cmd, desc in self.commands.items():
+            if self.gcode.gcode_help.get(cmd) != desc:
+                logging.warning("Help for deferred command %s does not match"
+                                " module %s", cmd, self.section)
+        # Invoke the handler that the module registered
+        cmd = params['#command']
+        self.gcode.gcode_handlers.get(cmd, self.gcode.cmd_default)(params)
+
+PROFILE_REPORT_COUNT = 10
+
 class Printer:
     config_error = ConfigParser.Error
-    def __init__(self, input_fd, bglogger, start_args):
+    def __init__(self, input_fd, bglogger, start_args, binlogger=None):
         self.bglogger = bglogger
+        self.binlogger = binlogger
+        self.stats_binlog_type = self.stats_binlog_fields = None
         self.start_args = start_args
         self.reactor = reactor.Reactor()
         gc = gcode.GCodeParser(self, input_fd)
         self.objects = collections.OrderedDict({'gcode': gc})
+        self.objects['metrics'] = metrics.MetricsRegistry()
         self.stats_timer = self.reactor.register_timer(self._stats)
         self.connect_timer = self.reactor.register_timer(
             self._connect, self.reactor.NOW)
@@ -144,10 +201,14 @@ class Printer:
         self.run_result = None
         self.stats_cb = []
         self.state_cb = []
+        self.load_profile = {}
+        self.load_profile_nested = []
     def get_start_args(self):
         return self.start_args
     def get_reactor(self):
         return self.reactor
+    def get_binary_logger(self):
+        return self.binlogger
     def get_state_message(self):
         return self.state_message
     def _set_state(self, msg):
@@ -176,13 +237,48 @@ class Printer:
         logging.info(info)
         if self.bglogger is not None:
             self.bglogger.set_rollover_info(name, info)
+    def _binlog_stats(self, eventtime):
+        names = []
+        values = []
+        for name, mtype, desc, samples in self.objects['metrics'].collect(
+                eventtime):
+            for labels, value in samples:
+                names.append("".join(["%s:" % (v,) for k, v in labels]) + name)
+                values.append(value)
+        if names != self.stats_binlog_fields:
+            self.stats_binlog_fields = names
+            self.stats_binlog_type = self.binlogger.register_type(
+                'stats', names)
+        self.binlogger.log(self.stats_binlog_type, eventtime, values)
     def _stats(self, eventtime, force_output=False):
         stats = [cb(eventtime) for cb in self.stats_cb]
+        if self.binlogger is not None:
+            # Also record the full metric values in the binary log
+            self._binlog_stats(eventtime)
         if max([s[0] for s in stats] + [force_output]):
             logging.info("Stats %.1f: %s", eventtime,
                          ' '.join([s[1] for s in stats]))
         return eventtime + 1.
-    def try_load_module(self, config, section):
+    def _profile_call(self, name, func, *args):
+        # Record the time spent in func (excluding nested profiled calls)
+        start_time = time.time()
+        self.load_profile_nested.append(0.)
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.time() - start_time
+            nested = self.load_profile_nested.pop()
+            if self.load_profile_nested:
+                self.load_profile_nested[-1] += elapsed
+            self.load_profile[name] = (self.load_profile.get(name, 0.)
+                                       + elapsed - nested)
+    def _report_load_profile(self, total_time):
+        items = sorted([(t, n) for n, t in self.load_profile.items()],
+                       reverse=True)[:PROFILE_REPORT_COUNT]
+        logging.info("Config load took %.3fs (slowest steps: %s)",
+                     total_time, ", ".join(["%s=%.1fms" % (n, t * 1000.)
+                                            for t, n in items]))
+    def try_load_module(self, config, section, defer=True):
         if section in self.objects:
             return self.objects[section]
         module_parts = section.split()
@@ -191,31 +287,48 @@ class Printer:
                                'extras', module_name + '.py')
         if not os.path.exists(py_name):
             return None
-        mod = importlib.import_module('extras.' + module_name)
+        if defer and module_name in DEFERRED_MODULES:
+            self.objects[section] = DeferredModule(
+                self, config, section, DEFERRED_MODULES[module_name])
+            return self.objects[section]
+        mod = self._profile_call("import " + module_name,
+                                 importlib.import_module,
+                                 'extras.' + module_name)
         init_func = 'load_config'
         if len(module_parts) > 1:
             init_func = 'load_config_prefix'
         init_func = getattr(mod, init_func, None)
         if init_func is not None:
-            self.objects[section] = init_func(config.getsection(section))
+            self.objects[section] = self._profile_call(
+                "init " + section, init_func, config.getsection(section))
             return self.objects[section]
+    def load_deferred_module(self, config, section):
+        del self.objects[section]
+        start_time = time.time()
+        obj = self.try_load_module(config, section, defer=False)
+        logging.info("Loaded deferred module %s in %.3fs",
+                     section, time.time() - start_time)
+        return obj
     def _read_config(self):
-        fileconfig = ConfigParser.RawConfigParser()
         config_file = self.start_args['config_file']
-        res = fileconfig.read(config_file)
-        if not res:
+        fileconfig = config_file_cache.read(config_file)
+        if fileconfig is None:
             raise self.config_error("Unable to open config file %s" % (
                 config_file,))
         if self.bglogger is not None:
             ConfigLogger(fileconfig, self.bglogger)
         # Create printer components
+        start_time = time.time()
         config = ConfigWrapper(self, fileconfig, 'printer')
         for m in [pins, heater, mcu]:
-            m.add_printer_objects(self, config)
+            self._profile_call("init " + m.__name__,
+                               m.add_printer_objects, self, config)
         for section in fileconfig.sections():
             self.try_load_module(config, section)
         for m in [toolhead, extruder]:
-            m.add_printer_objects(self, config)
+            self._profile_call("init " + m.__name__,
+                               m.add_printer_objects, self, config)
+        self._report_load_profile(time.time() - start_time)
         # Validate that there are no undefined parameters in the config file
         valid_sections = { s: 1 for s, o in self.all_config_options }
         for section_name in fileconfig.sections():
@@ -327,6 +440,8 @@ def main():
                     help="input tty name (default is /tmp/printer)")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
+    opts.add_option("-b", "--binlog", dest="binlog",
+                    help="write periodic stats to a binary log file")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="enable debug messages")
     opts.add_option("-o", "--debugoutput", dest="debugoutput",
@@ -339,7 +454,7 @@ def main():
         opts.error("Incorrect number of arguments")
     start_args = {'config_file': args[0], 'start_reason': 'startup'}
 
-    input_fd = bglogger = None
+    input_fd = bglogger = binlogger = None
 
     debuglevel = logging.INFO
     if options.verbose:
@@ -357,6 +472,8 @@ def main():
         bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
     else:
         logging.basicConfig(level=debuglevel)
+    if options.binlog:
+        binlogger = queuelogger.BinaryLogger(options.binlog)
     logging.info("Starting Klippy...")
     start_args['software_version'] = util.get_git_version()
     if bglogger is not None:
@@ -372,8 +489,9 @@ def main():
         if bglogger is not None:
             bglogger.clear_rollover_info()
             bglogger.set_rollover_info('versions', versions)
-        printer = Printer(input_fd, bglogger, start_args)
+        printer = Printer(input_fd, bglogger, start_args, binlogger)
         res = printer.run()
+        printer.get_reactor().finalize()
         if res in ['exit', 'error_exit']:
             break
         time.sleep(1.)
@@ -382,6 +500,8 @@ def main():
 
     if bglogger is not None:
         bglogger.stop()
+    if binlogger is not None:
+        binlogger.stop()
 
     if res == 'error_exit':
         sys.exit(-1)
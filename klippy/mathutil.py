@@ -3,38 +3,129 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import sys, math, logging, threading
 
-# Helper code that implements coordinate descent
-def coordinate_descent(adj_params, params, error_func):
-    # Define potential changes
-    params = dict(params)
-    dp = {param_name: 1. for param_name in adj_params}
-    # Calculate the error
-    best_err = error_func(params)
+# Solve the linear system a*x = b using gaussian elimination with
+# partial pivoting (returns None if the system is singular)
+def solve_linear(a, b):
+    n = len(b)
+    m = [list(row) + [v] for row, v in zip(a, b)]
+    for col in range(n):
+        pivot = max(range(col, n), key=(lambda r: abs(m[r][col])))
+        if abs(m[pivot][col]) < 1e-300:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, n):
+            f = m[r][col] / m[col][col]
+            if f:
+                m[r] = [v - f * pv for v, pv in zip(m[r], m[col])]
+    x = [0.] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (m[r][n] - sum([m[r][c] * x[c] for c in range(r + 1, n)])
+                ) / m[r][r]
+    return x
 
-    threshold = 0.00001
+# Helper code that implements Levenberg-Marquardt least squares
+# fitting.  The residual_func is passed a parameter dictionary and must
+# return a list of residuals (one per measurement).  The Jacobian is
+# computed with finite differences, evaluating all measurements for
+# each adjusted parameter.  If a progress dictionary is provided then
+# its 'rounds' and 'error' entries are updated after every round.
+# Returns the new parameters and residuals.
+def least_squares(adj_params, params, residual_func, max_rounds=200,
+                  progress=None):
+    params = dict(params)
+    adj_params = list(adj_params)
+    count = len(adj_params)
+    residuals = residual_func(params)
+    initial_err = best_err = sum([r**2 for r in residuals])
+    damping = 0.001
     rounds = 0
-
-    while sum(dp.values()) > threshold and rounds < 10000:
+    while rounds < max_rounds and best_err:
         rounds += 1
+        # Calculate the Jacobian (one column per parameter)
+        jac = []
         for param_name in adj_params:
             orig = params[param_name]
-            params[param_name] = orig + dp[param_name]
-            err = error_func(params)
-            if err < best_err:
-                # There was some improvement
-                best_err = err
-                dp[param_name] *= 1.1
+            step = 1e-7 * max(abs(orig), 1.)
+            params[param_name] = orig + step
+            new_residuals = residual_func(params)
+            params[param_name] = orig
+            jac.append([(nr - r) / step
+                        for r, nr in zip(residuals, new_residuals)])
+        jtj = [[sum([a * b for a, b in zip(jac[i], jac[j])])
+                for j in range(count)] for i in range(count)]
+        jtr = [-sum([a * r for a, r in zip(col, residuals)]) for col in jac]
+        # Find a step that reduces the error (increasing the damping
+        # towards gradient descent until one is found)
+        while damping < 1e15:
+            a = [list(row) for row in jtj]
+            for i in range(count):
+                a[i][i] += damping * max(jtj[i][i], 1e-12)
+            delta = solve_linear(a, jtr)
+            if delta is None:
+                damping *= 10.
                 continue
-            params[param_name] = orig - dp[param_name]
-            err = error_func(params)
+            new_params = dict(params)
+            for param_name, d in zip(adj_params, delta):
+                new_params[param_name] += d
+            new_residuals = residual_func(new_params)
+            err = sum([r**2 for r in new_residuals])
             if err < best_err:
-                # There was some improvement
-                best_err = err
-                dp[param_name] *= 1.1
-                continue
-            params[param_name] = orig
-            dp[param_name] *= 0.9
-    logging.info("Coordinate descent best_err: %s  rounds: %d", best_err, rounds)
-    return params
+                break
+            damping *= 10.
+        else:
+            # No further improvement possible
+            break
+        improvement = best_err - err
+        params, residuals, best_err = new_params, new_residuals, err
+        damping = max(damping * 0.1, 1e-12)
+        if progress is not None:
+            progress['rounds'] = rounds
+            progress['error'] = best_err
+        if (improvement <= 1e-12 * best_err
+            or max([abs(d) for d in delta]) < 1e-9):
+            break
+    logging.info("Least squares: rounds=%d error=%.9f (initial %.9f)"
+                 " max residual=%.6f", rounds, best_err, initial_err,
+                 max([abs(r) for r in residuals] + [0.]))
+    return params, residuals
+
+BACKGROUND_POLL_TIME = 0.050
+
+# Run func(*args) in a background thread so that the reactor keeps
+# processing events during a long calculation.  The calling greenlet
+# is paused until the calculation completes.  If report_func is
+# provided it is invoked (from the reactor) every report_time seconds
+# with the elapsed time.  Returns the result of func and the total
+# elapsed time; an exception raised by func is raised in the caller.
+def background_call(reactor, func, args=(), report_func=None,
+                    report_time=2.):
+    result = []
+    def run():
+        try:
+            result.append((func(*args), None))
+        except:
+            result.append((None, sys.exc_info()))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    start_time = eventtime = reactor.monotonic()
+    next_report = start_time + report_time
+    thread.start()
+    while not result:
+        eventtime = reactor.pause(eventtime + BACKGROUND_POLL_TIME)
+        if report_func is not None and eventtime >= next_report:
+            report_func(eventtime - start_time)
+            next_report = eventtime + report_time
+    thread.join()
+    res, exc_info = result[0]
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return res, reactor.monotonic() - start_time
+
+def format_residuals(residuals):
+    if not residuals:
+        return "no residuals"
+    rms = math.sqrt(sum([r**2 for r in residuals]) / len(residuals))
+    return "residual rms=%.6f max=%.6f" % (
+        rms, max([abs(r) for r in residuals]))
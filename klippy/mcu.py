@@ -126,6 +126,7 @@ class MCU_endstop:
     class TimeoutError(Exception):
         pass
     RETRY_QUERY = 1.000
+    QUERY_DELAY = 0.100
     def __init__(self, mcu, pin_params):
         self._mcu = mcu
         self._steppers = []
@@ -136,6 +137,7 @@ class MCU_endstop:
         self._homing = False
         self._min_query_time = self._next_query_time = 0.
         self._last_state = {}
+        self._state_completion = None
     def get_mcu(self):
         return self._mcu
     def add_stepper(self, stepper):
@@ -178,14 +180,31 @@ class MCU_endstop:
         for s in self._steppers:
             s.note_homing_start(clock)
     def home_wait(self, home_end_time):
+        # The mcu reports when the endstop triggers, so only query the
+        # endstop state if it has not triggered by the end of the move
         eventtime = self._mcu.monotonic()
+        est_print_time = self._mcu.estimated_print_time(eventtime)
+        self._next_query_time = (eventtime + self.QUERY_DELAY
+                                 + max(0., home_end_time - est_print_time))
         while self._check_busy(eventtime, home_end_time):
-            eventtime = self._mcu.pause(eventtime + 0.1)
+            eventtime = self._wait_state(eventtime)
     def home_finalize(self):
         pass
+    def _wait_state(self, eventtime):
+        # Wait for an end_stop_state message (or the next query time)
+        self._state_completion = self._mcu.completion()
+        self._state_completion.wait(
+            min(self._next_query_time, eventtime + self.RETRY_QUERY))
+        self._state_completion = None
+        return self._mcu.monotonic()
     def _handle_end_stop_state(self, params):
+        # Invoked from background thread
         logging.debug("end_stop_state %s", params)
         self._last_state = params
+        self._mcu.register_async_callback(self._notify_state)
+    def _notify_state(self, eventtime):
+        if self._state_completion is not None:
+            self._state_completion.complete(True)
     def _check_busy(self, eventtime, home_end_time=0.):
         # Check if need to send an end_stop_query command
         last_sent_time = self._last_state.get('#sent_time', -1.)
@@ -212,12 +231,17 @@ class MCU_endstop:
             self._query_cmd.send([self._oid])
         return True
     def query_endstop(self, print_time):
+        # Send the query now so that multiple endstops may be queried
+        # in parallel (the result is obtained via query_endstop_wait)
         self._homing = False
-        self._min_query_time = self._next_query_time = self._mcu.monotonic()
+        self._min_query_time = self._mcu.monotonic()
+        self._next_query_time = self._min_query_time + self.RETRY_QUERY
+        if not self._mcu.is_fileoutput():
+            self._query_cmd.send([self._oid])
     def query_endstop_wait(self):
         eventtime = self._mcu.monotonic()
         while self._check_busy(eventtime):
-            eventtime = self._mcu.pause(eventtime + 0.1)
+            eventtime = self._wait_state(eventtime)
         return self._last_state.get('pin', self._invert) ^ self._invert
 
 class MCU_digital_out:
@@ -392,6 +416,12 @@ class MCU_adc:
         if self._callback is not None:
             self._callback(last_read_time, last_value)
 
+# The pin resolved config commands (and their crc) are kept for the
+# life of the process so a RESTART with an unchanged config (and thus
+# unchanged unresolved commands) can reuse them.
+built_configs = {}
+MAX_BUILT_CONFIGS = 8
+
 class MCU:
     error = error
     def __init__(self, printer, config, clocksync):
@@ -436,6 +466,17 @@ class MCU:
         self._stepqueues = []
         self._steppersync = None
         # Stats
+        metrics = printer.lookup_object('metrics')
+        metrics.register_group(self._get_metrics, [
+            ('mcu_awake', 'gauge', "Fraction of time the mcu is awake"),
+            ('mcu_task_avg', 'gauge', "Average mcu task time (seconds)"),
+            ('mcu_task_stddev', 'gauge', "Stddev of mcu task time")],
+                               mcu=self._name)
+        self._serial.register_metrics(metrics, mcu=self._name)
+        self._clocksync.register_metrics(metrics, mcu=self._name)
+        binlogger = printer.get_binary_logger()
+        if binlogger is not None:
+            self._clocksync.setup_binary_log(binlogger, self._name)
         self._stats_sumsq_base = 0.
         self._mcu_tick_avg = 0.
         self._mcu_tick_stddev = 0.
@@ -507,19 +548,27 @@ class MCU:
         self._add_custom()
         self._config_cmds.insert(0, "allocate_oids count=%d" % (
             self._oid_count,))
-
-        # Resolve pin names
         mcu_type = self._serial.msgparser.get_constant('MCU')
-        pin_resolver = pins.PinResolver(mcu_type)
-        if self._pin_map is not None:
-            pin_resolver.update_aliases(self._pin_map)
-        for i, cmd in enumerate(self._config_cmds):
-            self._config_cmds[i] = pin_resolver.update_command(cmd)
-        for i, cmd in enumerate(self._init_cmds):
-            self._init_cmds[i] = pin_resolver.update_command(cmd)
-
-        # Calculate config CRC
-        self._config_crc = zlib.crc32('\n'.join(self._config_cmds)) & 0xffffffff
+        key = (mcu_type, self._pin_map,
+               tuple(self._config_cmds), tuple(self._init_cmds))
+        built = built_configs.get(key)
+        if built is None:
+            # Resolve pin names
+            pin_resolver = pins.PinResolver(mcu_type)
+            if self._pin_map is not None:
+                pin_resolver.update_aliases(self._pin_map)
+            config_cmds = [pin_resolver.update_command(cmd)
+                           for cmd in self._config_cmds]
+            init_cmds = [pin_resolver.update_command(cmd)
+                         for cmd in self._init_cmds]
+            # Calculate config CRC
+            config_crc = zlib.crc32('\n'.join(config_cmds)) & 0xffffffff
+            if len(built_configs) >= MAX_BUILT_CONFIGS:
+                built_configs.clear()
+            built_configs[key] = built = (config_cmds, init_cmds, config_crc)
+        config_cmds, init_cmds, self._config_crc = built
+        self._config_cmds = list(config_cmds)
+        self._init_cmds = list(init_cmds)
         self.add_config_cmd("finalize_config crc=%d" % (self._config_crc,))
     def _send_config(self):
         get_config_cmd = self.lookup_command("get_config")
@@ -657,6 +706,10 @@ class MCU:
         return self._reactor.pause(waketime)
     def monotonic(self):
         return self._reactor.monotonic()
+    def completion(self):
+        return self._reactor.completion()
+    def register_async_callback(self, callback):
+        self._reactor.register_async_callback(callback)
     # Restarts
     def _disconnect(self):
         self._serial.disconnect()
@@ -707,6 +760,10 @@ class MCU:
         return self._printer.get_start_args().get('debugoutput') is not None
     def is_shutdown(self):
         return self._is_shutdown
+    def get_name(self):
+        return self._name
+    def get_serial(self):
+        return self._serial
     def flush_moves(self, print_time):
         if self._steppersync is None:
             return
@@ -736,6 +793,10 @@ class MCU:
             self._mcu_tick_stddev)
         return False, ' '.join([msg, self._serial.stats(eventtime),
                                 self._clocksync.stats(eventtime)])
+    def _get_metrics(self, eventtime):
+        return {'mcu_awake': self._mcu_tick_awake,
+                'mcu_task_avg': self._mcu_tick_avg,
+                'mcu_task_stddev': self._mcu_tick_stddev}
     def printer_state(self, state):
         if state == 'connect':
             self._connect()
@@ -0,0 +1,81 @@
+# Registry of typed statistics with Prometheus style text export
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import math, logging, collections
+
+METRIC_PREFIX = "klipper_"
+METRIC_TYPES = ('counter', 'gauge')
+
+class error(Exception):
+    pass
+
+# Metric values are only obtained (via the registered callbacks) when
+# the metrics are collected, so registration has no cost on the code
+# paths that maintain the underlying values.
+class MetricsRegistry:
+    error = error
+    def __init__(self):
+        self.definitions = collections.OrderedDict()
+        self.groups = []
+    def define(self, name, mtype, desc):
+        if mtype not in METRIC_TYPES:
+            raise error("Invalid metric type '%s'" % (mtype,))
+        if (mtype == 'counter') != name.endswith('_total'):
+            raise error("Metric '%s': only counter names end in _total" % (
+                name,))
+        prev = self.definitions.get(name)
+        if prev is not None:
+            if prev[0] != mtype:
+                raise error("Metric '%s' already registered as %s" % (
+                    name, prev[0]))
+            return
+        self.definitions[name] = (mtype, desc)
+    # Register a callback that returns a dictionary of metric values.
+    # The 'metrics' parameter is a list of (name, type, description)
+    # tuples and the keyword arguments are labels for the values.
+    def register_group(self, callback, metrics, **labels):
+        for name, mtype, desc in metrics:
+            self.define(name, mtype, desc)
+        self.groups.append((callback, sorted(labels.items())))
+    def collect(self, eventtime):
+        samples = { name: [] for name in self.definitions }
+        for callback, labels in self.groups:
+            try:
+                values = callback(eventtime)
+            except:
+                logging.exception("Error collecting metrics")
+                continue
+            for name, value in values.items():
+                if name in samples and value is not None:
+                    samples[name].append((labels, value))
+        return [(name, mtype, desc, samples[name])
+                for name, (mtype, desc) in self.definitions.items()]
+    def export_text(self, eventtime):
+        out = []
+        for name, mtype, desc, samples in self.collect(eventtime):
+            if not samples:
+                continue
+            name = METRIC_PREFIX + name
+            out.append("# HELP %s %s" % (name, desc))
+            out.append("# TYPE %s %s" % (name, mtype))
+            for labels, value in samples:
+                label_str = ""
+                if labels:
+                    label_str = "{%s}" % (",".join([
+                        '%s="%s"' % (k, escape_label(v)) for k, v in labels]),)
+                out.append("%s%s %s" % (name, label_str, format_value(value)))
+        return "\n".join(out) + "\n"
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def format_value(value):
+    value = float(value)
+    if math.isinf(value):
+        return ["-Inf", "+Inf"][value > 0.]
+    if math.isnan(value):
+        return "NaN"
+    return repr(value)
@@ -22,20 +22,32 @@ MESSAGE_PAYLOAD_MAX = MESSAGE_MAX - MESSAGE_MIN
 MESSAGE_SEQ_MASK = 0x0f
 MESSAGE_DEST = 0x10
 MESSAGE_SYNC = '\x7E'
+MESSAGE_SYNC_BYTE = 0x7E
 
 class error(Exception):
     pass
 
-def crc16_ccitt(buf):
+# Lookup table for crc16_ccitt() - each entry is the crc update for
+# the low byte of (crc ^ data)
+def _build_crc16_table():
+    table = []
+    for i in range(256):
+        data = i ^ ((i << 4) & 0xff)
+        table.append((data << 8) ^ (data >> 4) ^ (data << 3))
+    return table
+CRC16_TABLE = _build_crc16_table()
+
+def crc16_ccitt_value(buf, start=0, end=None):
     crc = 0xffff
-    for data in buf:
-        data = ord(data)
-        data ^= crc & 0xff
-        data ^= (data & 0x0f) << 4
-        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
-    crc = chr(crc >> 8) + chr(crc & 0xff)
+    table = CRC16_TABLE
+    for data in bytearray(buf[start:end]):
+        crc = (crc >> 8) ^ table[(crc ^ data) & 0xff]
     return crc
 
+def crc16_ccitt(buf):
+    crc = crc16_ccitt_value(buf)
+    return chr(crc >> 8) + chr(crc & 0xff)
+
 class PT_uint32:
     is_int = 1
     max_length = 5
@@ -194,23 +206,64 @@ class MessageParser:
     def check_packet(self, s):
         if len(s) < MESSAGE_MIN:
             return 0
-        msglen = ord(s[MESSAGE_POS_LEN])
+        s = bytearray(s[:MESSAGE_MAX])
+        msglen = s[MESSAGE_POS_LEN]
         if msglen < MESSAGE_MIN or msglen > MESSAGE_MAX:
             return -1
-        msgseq = ord(s[MESSAGE_POS_SEQ])
+        msgseq = s[MESSAGE_POS_SEQ]
         if (msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST:
             return -1
         if len(s) < msglen:
             # Need more data
             return 0
-        if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC:
+        if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC_BYTE:
             return -1
-        msgcrc = s[msglen-MESSAGE_TRAILER_CRC:msglen-MESSAGE_TRAILER_CRC+2]
-        crc = crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
+        msgcrc = ((s[msglen-MESSAGE_TRAILER_CRC] << 8)
+                  | s[msglen-MESSAGE_TRAILER_CRC+1])
+        crc = crc16_ccitt_value(s, 0, msglen-MESSAGE_TRAILER_SIZE)
         if crc != msgcrc:
-            #logging.debug("got crc %s vs %s", repr(crc), repr(msgcrc))
+            #logging.debug("got crc %04x vs %04x", crc, msgcrc)
             return -1
         return msglen
+    # Locate all complete packets in a buffer.  Returns a list of
+    # (start, end) offsets of the valid packets found, the offset of
+    # the first unprocessed byte, and the number of invalid bytes that
+    # were discarded.  Like the C serialqueue code, invalid data is
+    # discarded up to and including the next sync byte.
+    def split_packets(self, s, pos=0):
+        if not isinstance(s, bytearray):
+            s = bytearray(s)
+        packets = []
+        invalid = 0
+        slen = len(s)
+        table = CRC16_TABLE
+        while slen - pos >= MESSAGE_MIN:
+            msglen = s[pos+MESSAGE_POS_LEN]
+            msgseq = s[pos+MESSAGE_POS_SEQ]
+            if (msglen >= MESSAGE_MIN and msglen <= MESSAGE_MAX
+                and (msgseq & ~MESSAGE_SEQ_MASK) == MESSAGE_DEST):
+                end = pos + msglen
+                if end > slen:
+                    # Need more data
+                    break
+                if s[end-MESSAGE_TRAILER_SYNC] == MESSAGE_SYNC_BYTE:
+                    crc = 0xffff
+                    for data in s[pos:end-MESSAGE_TRAILER_SIZE]:
+                        crc = (crc >> 8) ^ table[(crc ^ data) & 0xff]
+                    crcpos = end - MESSAGE_TRAILER_CRC
+                    if crc == (s[crcpos] << 8) | s[crcpos+1]:
+                        packets.append((pos, end))
+                        pos = end
+                        continue
+            # Discard bytes until next sync found
+            next_sync = s.find(MESSAGE_SYNC, pos)
+            if next_sync < 0:
+                invalid += slen - pos
+                pos = slen
+                break
+            invalid += next_sync + 1 - pos
+            pos = next_sync + 1
+        return packets, pos, invalid
     def dump(self, s):
         msgseq = s[MESSAGE_POS_SEQ]
         out = ["seq: %02x" % (msgseq,)]
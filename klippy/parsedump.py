@@ -1,45 +1,164 @@
 #!/usr/bin/env python2
 # Script to parse a serial port data dump
 #
-# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+# Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging
+import os, sys, optparse, logging, multiprocessing, collections
 import msgproto
 
+READ_SIZE = 256 * 1024
+# Large files are decoded in fixed size ranges so that the memory
+# used by each worker (and by the parent) does not grow with the size
+# of the file.
+SPLIT_SIZE = 4 * 1024 * 1024
+
 def read_dictionary(filename):
     dfile = open(filename, 'rb')
     dictionary = dfile.read()
     dfile.close()
     return dictionary
 
+# Iterate over the (file offset, packet) of each valid packet in a
+# data dump.  Data is read in large blocks into a single bytearray and
+# each block is split into packets with a single call.  If 'start' is
+# given, decoding begins at the first packet following a sync byte at
+# or after that offset, and only packets that begin before 'end' are
+# reported.
+def iter_packets(mp, f, start=0, end=None):
+    buf = bytearray()
+    pos = offset = 0
+    need_sync = False
+    if start:
+        f.seek(start - 1)
+        offset = start - 1
+        need_sync = True
+    while 1:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        del buf[:pos]
+        offset += pos
+        buf.extend(data)
+        pos = 0
+        if need_sync:
+            # Resynchronize on the byte following the next sync byte
+            pos = buf.find(msgproto.MESSAGE_SYNC)
+            if pos < 0:
+                pos = len(buf)
+                continue
+            pos += 1
+            need_sync = False
+        packets, pos, invalid = mp.split_packets(buf, pos)
+        if invalid:
+            logging.error("Discarded %d bytes of invalid data near offset %d",
+                          invalid, offset)
+        for pstart, pend in packets:
+            if end is not None and offset + pstart >= end:
+                return
+            yield offset + pstart, buf[pstart:pend]
+    if pos < len(buf):
+        logging.error("Truncated data at offset %d", offset + pos)
+
+# Iterate over the (message format, params, message length) of each
+# message within a sequence of packets
+def iter_messages(mp, packets):
+    messages_by_id = mp.messages_by_id
+    unknown = mp.unknown
+    for offset, s in packets:
+        msgpos = msgproto.MESSAGE_HEADER_SIZE
+        msgend = len(s) - msgproto.MESSAGE_TRAILER_SIZE
+        while msgpos < msgend:
+            mid = messages_by_id.get(s[msgpos], unknown)
+            params, newpos = mid.parse(s, msgpos)
+            yield mid, params, newpos - msgpos
+            msgpos = newpos
+
+# Generate the text output for a section of a data dump
+def dump_text(mp, f, start=0, end=None, names=None):
+    packets = iter_packets(mp, f, start, end)
+    for mid, params, msglen in iter_messages(mp, packets):
+        if names is None or mid.name in names:
+            yield mid.format_params(params)
+
+def write_lines(lines, out):
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) >= 1024:
+            block.append('')
+            out.write('\n'.join(block))
+            block = []
+    if block:
+        block.append('')
+        out.write('\n'.join(block))
+
+
+######################################################################
+# Multi-process decoding
+######################################################################
+
+def decode_range(args):
+    dictionary, data_filename, start, end, names = args
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    f = open(data_filename, 'rb')
+    lines = list(dump_text(mp, f, start, end, names))
+    f.close()
+    if not lines:
+        return ""
+    return '\n'.join(lines) + '\n'
+
+def dump_parallel(dictionary, data_filename, names, jobs, out):
+    size = os.path.getsize(data_filename)
+    ranges = ((dictionary, data_filename, start, start + SPLIT_SIZE, names)
+              for start in xrange(0, size, SPLIT_SIZE))
+    # Only keep a few ranges outstanding so that decoded text is not
+    # queued up in memory faster than it can be written
+    pool = multiprocessing.Pool(jobs)
+    pending = collections.deque()
+    try:
+        for r in ranges:
+            pending.append(pool.apply_async(decode_range, (r,)))
+            if len(pending) >= jobs * 2:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
+    finally:
+        pool.terminate()
+
+######################################################################
+# Startup
+######################################################################
+
 def main():
-    dict_filename, data_filename = sys.argv[1:]
+    usage = "%prog [options] <dictionary> <data file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--names", dest="names",
+                    help="only output the given (comma separated) messages")
+    opts.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                    help="number of processes to use for large files")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    dict_filename, data_filename = args
+    names = None
+    if options.names:
+        names = set(n.strip() for n in options.names.split(','))
 
     dictionary = read_dictionary(dict_filename)
 
+    if options.jobs > 1:
+        dump_parallel(dictionary, data_filename, names, options.jobs,
+                      sys.stdout)
+        return
+
     mp = msgproto.MessageParser()
     mp.process_identify(dictionary, decompress=False)
 
     f = open(data_filename, 'rb')
-    fd = f.fileno()
-    data = ""
-    while 1:
-        newdata = os.read(fd, 4096)
-        if not newdata:
-            break
-        data += newdata
-        while 1:
-            l = mp.check_packet(data)
-            if l == 0:
-                break
-            if l < 0:
-                logging.error("Invalid data")
-                data = data[-l:]
-                continue
-            msgs = mp.dump(bytearray(data[:l]))
-            sys.stdout.write('\n'.join(msgs[1:]) + '\n')
-            data = data[l:]
+    write_lines(dump_text(mp, f, names=names), sys.stdout)
+    f.close()
 
 if __name__ == '__main__':
     main()
@@ -3,7 +3,6 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import re
 
 
 ######################################################################
@@ -158,32 +157,53 @@ def update_map_beaglebone(pins, mcu):
 # Command translation
 ######################################################################
 
-re_pin = re.compile(r'(?P<prefix>[ _]pin=)(?P<name>[^ ]*)')
+# Pin name to pin id maps are built once for each mcu type and alias
+# mapping and are then shared by all PinResolver instances
+pin_maps = {}
+
+def get_pin_map(mcu_type, mapping_name=None):
+    key = (mcu_type, mapping_name)
+    pins = pin_maps.get(key)
+    if pins is None:
+        pins = dict(MCU_PINS.get(mcu_type, {}))
+        if mapping_name == 'arduino':
+            update_map_arduino(pins, mcu_type)
+        elif mapping_name == 'beaglebone':
+            update_map_beaglebone(pins, mcu_type)
+        pin_maps[key] = pins
+    return pins
 
 class PinResolver:
     def __init__(self, mcu_type, validate_aliases=True):
         self.mcu_type = mcu_type
         self.validate_aliases = validate_aliases
-        self.pins = dict(MCU_PINS.get(mcu_type, {}))
+        self.pins = get_pin_map(mcu_type)
         self.active_pins = {}
     def update_aliases(self, mapping_name):
-        self.pins = dict(MCU_PINS.get(self.mcu_type, {}))
-        if mapping_name == 'arduino':
-            update_map_arduino(self.pins, self.mcu_type)
-        elif mapping_name == 'beaglebone':
-            update_map_beaglebone(self.pins, self.mcu_type)
+        self.pins = get_pin_map(self.mcu_type, mapping_name)
+    def lookup_pin_id(self, name, cmd):
+        pin_id = self.pins.get(name)
+        if pin_id is None:
+            raise error("Unable to translate pin name: %s" % (cmd,))
+        if (name != self.active_pins.setdefault(pin_id, name)
+            and self.validate_aliases):
+            raise error("pin %s is an alias for %s" % (
+                name, self.active_pins[pin_id]))
+        return str(pin_id)
     def update_command(self, cmd):
-        def pin_fixup(m):
-            name = m.group('name')
-            if name not in self.pins:
-                raise error("Unable to translate pin name: %s" % (cmd,))
-            pin_id = self.pins[name]
-            if (name != self.active_pins.setdefault(pin_id, name)
-                and self.validate_aliases):
-                raise error("pin %s is an alias for %s" % (
-                    name, self.active_pins[pin_id]))
-            return m.group('prefix') + str(pin_id)
-        return re_pin.sub(pin_fixup, cmd)
+        # Replace the value of each " pin=" or "_pin=" parameter
+        if 'pin=' not in cmd:
+            return cmd
+        parts = cmd.split(' ')
+        for i, part in enumerate(parts):
+            pos = part.find('pin=')
+            while pos >= 0:
+                if (i and not pos) or (pos and part[pos-1] == '_'):
+                    parts[i] = part[:pos+4] + self.lookup_pin_id(
+                        part[pos+4:], cmd)
+                    break
+                pos = part.find('pin=', pos + 1)
+        return ' '.join(parts)
 
 
 ######################################################################
@@ -3,7 +3,7 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, logging.handlers, threading, Queue, time
+import logging, logging.handlers, threading, Queue, time, os, struct
 
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
@@ -52,6 +52,165 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
         self.emit(logging.makeLogRecord(
             {'msg': "\n".join(lines), 'level': logging.INFO}))
 
+
+######################################################################
+# Binary log channel
+######################################################################
+
+# A binary log file starts with BINLOG_MAGIC and is followed by a
+# series of records.  Each record has a header (payload length, type
+# id, and time) followed by its payload.  Records with a type id of 0
+# define a record type - their payload is the new type id followed by
+# the nul separated type name, struct format, and field names.  The
+# payload of all other records is the struct packed field values.
+BINLOG_MAGIC = "KLBINLOG\x01\0\0\0"
+RECORD_HEADER = struct.Struct("<HHd")
+DEFINE_TYPE_ID = 0
+
+# Class to serialize raw record tuples to a binary file in a
+# background thread.  Only a tuple is queued on the caller's thread.
+# A type registered again with the same name, format, and fields
+# reuses its type id.  Each file starts with the definitions of the
+# types that are currently in use (the last type registered with each
+# name), and any other type is defined before its first record in the
+# file.
+class BinaryLogger:
+    def __init__(self, filename, max_bytes=32*1024*1024, backup_count=5):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.next_type_id = DEFINE_TYPE_ID + 1
+        self.type_ids = {}
+        self.live_types = {}
+        self.type_lock = threading.Lock()
+        self.bg_queue = Queue.Queue()
+        self.is_failed = False
+        # State only accessed from the background thread
+        self.definitions = {}
+        self.type_structs = {}
+        self.bg_live_types = {}
+        self.file_types = set()
+        self.file = None
+        self.file_size = 0
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.start()
+    def register_type(self, name, fields, fmt=None):
+        if fmt is None:
+            fmt = 'd' * len(fields)
+        key = (name, fmt, tuple(fields))
+        with self.type_lock:
+            type_id = self.type_ids.get(key)
+            if type_id is None:
+                type_id = self.next_type_id
+                self.next_type_id += 1
+                self.type_ids[key] = type_id
+            elif self.live_types.get(name) == type_id:
+                return type_id
+            self.live_types[name] = type_id
+        if not self.is_failed:
+            self.bg_queue.put_nowait(
+                (DEFINE_TYPE_ID, time.time(), (type_id, name, fmt, fields)))
+        return type_id
+    def log(self, type_id, eventtime, values):
+        if not self.is_failed:
+            self.bg_queue.put_nowait((type_id, eventtime, values))
+    def stop(self):
+        self.bg_queue.put_nowait(None)
+        self.bg_thread.join()
+    def _bg_thread(self):
+        try:
+            self._open_file()
+        except (IOError, OSError):
+            logging.exception("Unable to open binary log %s", self.filename)
+            self.is_failed = True
+            return
+        while 1:
+            record = self.bg_queue.get(True)
+            if record is None:
+                break
+            try:
+                self._write_record(*record)
+            except (IOError, OSError):
+                # Stop queuing records that can not be written
+                logging.exception("Unable to write binary log %s",
+                                  self.filename)
+                self.is_failed = True
+                break
+            except Exception:
+                logging.exception("Unable to write binary log record")
+            if self.bg_queue.empty():
+                self.file.flush()
+        if not self.file.closed:
+            self.file.close()
+    def _open_file(self):
+        self.file = open(self.filename, 'ab')
+        self.file_size = self.file.tell()
+        self.file_types = set()
+        if not self.file_size:
+            self.file.write(BINLOG_MAGIC)
+            self.file_size = len(BINLOG_MAGIC)
+        for type_id in sorted(self.bg_live_types.values()):
+            self._write_definition(type_id)
+    def _rollover(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%d" % (self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.filename, i + 1))
+        if self.backup_count:
+            os.rename(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self._open_file()
+    def _write_data(self, type_id, eventtime, payload):
+        data = RECORD_HEADER.pack(len(payload), type_id, eventtime) + payload
+        self.file.write(data)
+        self.file_size += len(data)
+    def _write_definition(self, type_id):
+        self.file_types.add(type_id)
+        self._write_data(DEFINE_TYPE_ID, time.time(),
+                         self.definitions[type_id])
+    def _write_record(self, type_id, eventtime, values):
+        if type_id == DEFINE_TYPE_ID:
+            new_type_id, name, fmt, fields = values
+            if new_type_id not in self.definitions:
+                self.definitions[new_type_id] = struct.pack(
+                    "<H", new_type_id) + "\0".join([name, fmt] + list(fields))
+                self.type_structs[new_type_id] = struct.Struct('<' + fmt)
+            self.bg_live_types[name] = new_type_id
+            if new_type_id not in self.file_types:
+                self._write_definition(new_type_id)
+            return
+        payload = self.type_structs[type_id].pack(*values)
+        if self.file_size + RECORD_HEADER.size + len(payload) > self.max_bytes:
+            self._rollover()
+        if type_id not in self.file_types:
+            self._write_definition(type_id)
+        self._write_data(type_id, eventtime, payload)
+
+# Iterate over the (type name, time, [(field, value), ...]) of each
+# record in a binary log file
+def read_binary_log(f):
+    if f.read(len(BINLOG_MAGIC)) != BINLOG_MAGIC:
+        raise ValueError("Not a binary log file")
+    definitions = {}
+    while 1:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            break
+        length, type_id, eventtime = RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            break
+        if type_id == DEFINE_TYPE_ID:
+            new_type_id = struct.unpack_from("<H", payload)[0]
+            parts = payload[2:].split("\0")
+            name, fmt, fields = parts[0], parts[1], parts[2:]
+            definitions[new_type_id] = (name, struct.Struct('<' + fmt), fields)
+            continue
+        name, st, fields = definitions[type_id]
+        yield name, eventtime, zip(fields, st.unpack(payload))
+
 def setup_bg_logging(filename, debuglevel):
     ql = QueueListener(filename)
     qh = QueueHandler(ql.bg_queue)
@@ -3,13 +3,15 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import select, math, time
+import os, select, math, time, errno, Queue
 import greenlet
-import chelper
+import chelper, util
+
+_NEVER = 9999999999999999.
 
 class ReactorTimer:
     def __init__(self, callback, waketime):
-        self.callback = callback
+        self.callback = self.orig_callback = callback
         self.waketime = waketime
 
 class ReactorFileHandler:
@@ -24,9 +26,34 @@ class ReactorGreenlet(greenlet.greenlet):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
 
+# Helper that lets a greenlet wait for a result that is provided by
+# another greenlet (or by an async callback).
+class ReactorCompletion:
+    class sentinel: pass
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = self.sentinel
+        self.waiting = []
+    def test(self):
+        return self.result is not self.sentinel
+    def complete(self, result):
+        self.result = result
+        for wait in self.waiting:
+            if getattr(wait, 'timer', None) is not None:
+                self.reactor.update_timer(wait.timer, self.reactor.NOW)
+    def wait(self, waketime=_NEVER, waketime_result=None):
+        if self.result is self.sentinel:
+            wait = greenlet.getcurrent()
+            self.waiting.append(wait)
+            self.reactor.pause(waketime)
+            self.waiting.remove(wait)
+            if self.result is self.sentinel:
+                return waketime_result
+        return self.result
+
 class SelectReactor:
     NOW = 0.
-    NEVER = 9999999999999999.
+    NEVER = _NEVER
     def __init__(self):
         self._fds = []
         self._timers = []
@@ -34,7 +61,11 @@ class SelectReactor:
         self._process = False
         self._g_dispatch = None
         self._greenlets = []
+        self._timer_wrapper = None
         self.monotonic = chelper.get_ffi()[1].get_monotonic
+        # Callbacks requested from other threads
+        self._async_queue = Queue.Queue()
+        self._pipe_fds = None
     # Timers
     def _note_time(self, t):
         nexttime = t.waketime
@@ -45,6 +76,8 @@ class SelectReactor:
         self._note_time(t)
     def register_timer(self, callback, waketime = NEVER):
         handler = ReactorTimer(callback, waketime)
+        if self._timer_wrapper is not None:
+            handler.callback = self._timer_wrapper(callback)
         timers = list(self._timers)
         timers.append(handler)
         self._timers = timers
@@ -54,6 +87,13 @@ class SelectReactor:
         timers = list(self._timers)
         timers.pop(timers.index(handler))
         self._timers = timers
+    def set_timer_wrapper(self, wrapper):
+        # Wrap all timer callbacks (eg, for tracing) - None to restore
+        self._timer_wrapper = wrapper
+        for t in self._timers:
+            t.callback = t.orig_callback
+            if wrapper is not None:
+                t.callback = wrapper(t.orig_callback)
     def _check_timers(self, eventtime):
         if eventtime < self._next_timer:
             return min(1., max(.001, self._next_timer - eventtime))
@@ -96,6 +136,46 @@ class SelectReactor:
         g_old.timer = None
         self._g_dispatch.switch(self.NEVER)
         self._g_dispatch = g_old
+    def completion(self):
+        return ReactorCompletion(self)
+    # Async callbacks (callbacks scheduled from other threads)
+    def _setup_async_callbacks(self):
+        self._pipe_fds = os.pipe()
+        for fd in self._pipe_fds:
+            util.set_nonblock(fd)
+        self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
+        # Run any callbacks queued before the reactor was started
+        os.write(self._pipe_fds[1], '.')
+    def register_async_callback(self, callback):
+        # Run callback(eventtime) from the reactor (thread safe)
+        self._async_queue.put_nowait(callback)
+        pipe_fds = self._pipe_fds
+        if pipe_fds is None:
+            # Reactor not running - callback is run once it is started
+            return
+        try:
+            os.write(pipe_fds[1], '.')
+        except OSError as e:
+            # A full pipe means a wakeup is already pending
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+    def _got_pipe_signal(self, eventtime):
+        try:
+            os.read(self._pipe_fds[0], 4096)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while 1:
+            try:
+                callback = self._async_queue.get_nowait()
+            except Queue.Empty:
+                break
+            callback(eventtime)
+    def finalize(self):
+        if self._pipe_fds is not None:
+            for fd in self._pipe_fds:
+                os.close(fd)
+            self._pipe_fds = None
     # File descriptors
     def register_fd(self, fd, callback):
         handler = ReactorFileHandler(fd, callback)
@@ -119,6 +199,8 @@ class SelectReactor:
                     break
         self._g_dispatch = None
     def run(self):
+        if self._pipe_fds is None:
+            self._setup_async_callbacks()
         self._process = True
         g_next = ReactorGreenlet(run=self._dispatch_loop)
         g_next.switch()
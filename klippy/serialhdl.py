@@ -11,6 +11,28 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Metrics obtained from the fields of struct serialqueue_stats
+SERIAL_METRICS = [
+    ('bytes_write', 'serial_bytes_write_total', 'counter',
+     "Bytes written to the mcu"),
+    ('bytes_read', 'serial_bytes_read_total', 'counter',
+     "Bytes read from the mcu"),
+    ('bytes_retransmit', 'serial_bytes_retransmit_total', 'counter',
+     "Bytes retransmitted"),
+    ('bytes_invalid', 'serial_bytes_invalid_total', 'counter',
+     "Invalid bytes received"),
+    ('send_seq', 'serial_send_seq_total', 'counter', "Messages sent"),
+    ('receive_seq', 'serial_receive_seq_total', 'counter',
+     "Messages received"),
+    ('retransmit_seq', 'serial_retransmit_seq', 'gauge',
+     "Last retransmit sequence"),
+    ('srtt', 'serial_srtt', 'gauge', "Smoothed round trip time (seconds)"),
+    ('rttvar', 'serial_rttvar', 'gauge', "Round trip time variance"),
+    ('rto', 'serial_rto', 'gauge', "Retransmit timeout (seconds)"),
+    ('ready_bytes', 'serial_ready_bytes', 'gauge', "Bytes ready to be sent"),
+    ('stalled_bytes', 'serial_stalled_bytes', 'gauge',
+     "Bytes waiting on their scheduled time")]
+
 class SerialReader:
     BITS_PER_BYTE = 10.
     def __init__(self, reactor, serialport, baud):
@@ -25,6 +47,7 @@ class SerialReader:
         self.serialqueue = None
         self.default_cmd_queue = self.alloc_command_queue()
         self.stats_buf = self.ffi_main.new('char[4096]')
+        self.stats_data = self.ffi_main.new('struct serialqueue_stats *')
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
@@ -117,6 +140,17 @@ class SerialReader:
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
         return self.ffi_main.string(self.stats_buf)
+    def register_metrics(self, metrics, **labels):
+        metrics.register_group(self.get_metrics, [
+            (name, mtype, desc) for field, name, mtype, desc in SERIAL_METRICS],
+                               **labels)
+    def get_metrics(self, eventtime):
+        if self.serialqueue is None:
+            return {}
+        stats = self.stats_data
+        self.ffi_lib.serialqueue_get_stats_data(self.serialqueue, stats)
+        return {name: getattr(stats, field)
+                for field, name, mtype, desc in SERIAL_METRICS}
     # Serial response callbacks
     def register_callback(self, callback, name, oid=None):
         with self.lock:
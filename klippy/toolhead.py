@@ -234,6 +234,13 @@ class ToolHead:
                     'delta': delta.DeltaKinematics}
         self.kin = config.getchoice('kinematics', kintypes)(
             self, printer, config)
+        # Metrics
+        metrics = printer.lookup_object('metrics')
+        metrics.register_group(self._get_metrics, [
+            ('toolhead_print_time', 'gauge', "Last scheduled print time"),
+            ('toolhead_buffer_time', 'gauge',
+             "Time (in seconds) of moves buffered in the mcu"),
+            ('toolhead_print_stall_total', 'counter', "Print stalls detected")])
         # SET_VELOCITY_LIMIT command
         gcode = printer.lookup_object('gcode')
         gcode.register_command('SET_VELOCITY_LIMIT', self.cmd_SET_VELOCITY_LIMIT,
@@ -383,6 +390,11 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.sync_print_time
         return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
             self.print_time, max(buffer_time, 0.), self.print_stall)
+    def _get_metrics(self, eventtime):
+        buffer_time = self.print_time - self.mcu.estimated_print_time(eventtime)
+        return {'toolhead_print_time': self.print_time,
+                'toolhead_buffer_time': max(buffer_time, 0.),
+                'toolhead_print_stall_total': self.print_stall}
     def get_status(self, eventtime):
         buffer_time = self.print_time - self.mcu.estimated_print_time(eventtime)
         if buffer_time > -1. or not self.sync_print_time:
@@ -392,7 +404,11 @@ class ToolHead:
         else:
             status = "Idle"
         printing_time = self.print_time - self.last_print_start_time
-        return {'status': status, 'printing_time': printing_time}
+        return {'status': status, 'printing_time': printing_time,
+                'print_time': self.print_time,
+                'buffer_time': max(buffer_time, 0.),
+                'print_stall': self.print_stall,
+                'position': list(self.commanded_pos)}
     def printer_state(self, state):
         if state == 'shutdown':
             try:
@@ -0,0 +1,38 @@
+#!/usr/bin/env python2
+# Script to convert a klippy binary log file to text
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import queuelogger
+
+def format_value(value):
+    if isinstance(value, float):
+        return "%.6g" % (value,)
+    return str(value)
+
+def dump_file(filename, types):
+    f = open(filename, 'rb')
+    for name, eventtime, values in queuelogger.read_binary_log(f):
+        if types and name.split()[0] not in types:
+            continue
+        sys.stdout.write("%s %.3f: %s\n" % (name, eventtime, " ".join(
+            ["%s=%s" % (field, format_value(value))
+             for field, value in values])))
+    f.close()
+
+def main():
+    usage = "%prog [options] <binlog> [<binlog> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--type", action="append", dest="types",
+                    default=[], help="only show records of the given type")
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Incorrect number of arguments")
+    for filename in args:
+        dump_file(filename, options.types)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import optparse, datetime
+import logindex
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot, matplotlib.dates, matplotlib.font_manager
@@ -14,23 +15,31 @@ MAXBANDWIDTH=25000.
 MAXBUFFER=2.
 STATS_INTERVAL=5.
 TASK_MAX=0.0025
+STATS_GAP=1.
 
 APPLY_PREFIX = ['mcu_awake', 'mcu_task_avg', 'mcu_task_stddev', 'bytes_write',
                 'bytes_read', 'bytes_retransmit', 'freq', 'adj']
 
-def parse_log(logname, mcu):
+def parse_log(logname, mcu, start_time=None, end_time=None, index_dir=None):
     if mcu is None:
         mcu = "mcu"
     mcu_prefix = mcu + ":"
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
     f = open(logname, 'rb')
+    if start_time is not None:
+        # Skip directly to the requested time range
+        index = logindex.load_index(logname, index_dir)
+        f.seek(index.find_stats(start_time))
     out = []
     for line in f:
+        if not logindex.is_stats_line(line):
+            continue
         parts = line.split()
-        if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
-            #if parts and parts[0] == 'INFO:root:shutdown:':
-            #    break
+        sampletime = float(parts[1][:-1])
+        if start_time is not None and sampletime < start_time:
             continue
+        if end_time is not None and sampletime > end_time:
+            break
         prefix = ""
         keyparts = {}
         for p in parts[2:]:
@@ -45,11 +54,31 @@ def parse_log(logname, mcu):
             keyparts[name] = val
         if keyparts.get('bytes_write', '0') == '0':
             continue
-        keyparts['#sampletime'] = float(parts[1][:-1])
+        keyparts['#sampletime'] = sampletime
         out.append(keyparts)
     f.close()
     return out
 
+def parse_log_args(args):
+    return parse_log(*args)
+
+# The Stats sample times are the host's monotonic clock, which restarts
+# with each host boot.  When a log's times do not follow on from the
+# previous log, shift them so the log starts just after the previous
+# one ends.  Logs are laid end to end in the order given.
+def merge_logs(logdatas):
+    data = []
+    for logdata in logdatas:
+        if not logdata:
+            continue
+        if data and logdata[0]['#sampletime'] <= data[-1]['#sampletime']:
+            offset = (data[-1]['#sampletime'] + STATS_GAP
+                      - logdata[0]['#sampletime'])
+            for d in logdata:
+                d['#sampletime'] += offset
+        data.extend(logdata)
+    return data
+
 def find_print_restarts(data):
     runoff_samples = {}
     last_runoff_start = last_buffer_time = last_sampletime = 0.
@@ -169,17 +198,27 @@ def plot_frequency(data, outname, mcu):
     fig.savefig(outname)
 
 def main():
-    usage = "%prog [options] <logfile> <outname>"
+    usage = "%prog [options] <logfile> [<logfile> ...] <outname>"
     opts = optparse.OptionParser(usage)
     opts.add_option("-f", "--frequency", action="store_true",
                     help="graph mcu frequency")
     opts.add_option("-m", "--mcu", type="string", dest="mcu", default=None,
                     help="limit stats to the given mcu")
+    opts.add_option("-s", "--start", type="float", dest="start",
+                    help="ignore stats before the given sample time")
+    opts.add_option("-e", "--end", type="float", dest="end",
+                    help="ignore stats after the given sample time")
+    opts.add_option("-j", "--jobs", type="int", dest="jobs",
+                    help="number of log files to parse in parallel")
+    opts.add_option("-i", "--index-dir", type="string", dest="index_dir",
+                    help="directory to store log index files in")
     options, args = opts.parse_args()
-    if len(args) != 2:
+    if len(args) < 2:
         opts.error("Incorrect number of arguments")
-    logname, outname = args
-    data = parse_log(logname, options.mcu)
+    lognames, outname = args[:-1], args[-1]
+    data = merge_logs(logindex.map_parallel(parse_log_args, [
+        (logname, options.mcu, options.start, options.end, options.index_dir)
+        for logname in lognames], options.jobs))
     if not data:
         return
     if options.frequency:
@@ -9,7 +9,7 @@ SYSTEMDDIR="/etc/systemd/system"
 install_packages()
 {
     # Packages for python cffi
-    PKGLIST="python-virtualenv libffi-devel"
+    PKGLIST="python-virtualenv python-devel libffi-devel"
     # kconfig requirements
     PKGLIST="${PKGLIST} ncurses-devel"
     # hub-ctrl
@@ -4,7 +4,8 @@
 # Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, re, collections
+import re, collections, optparse
+import logindex
 
 def format_comment(line_num, line):
     return "# %6d: %s" % (line_num, line)
@@ -254,41 +255,70 @@ class GatherShutdown:
 # Startup
 ######################################################################
 
-def main():
-    logname = sys.argv[1]
+def process_log(args):
+    logname, index_dir = args
+    index = logindex.load_index(logname, index_dir)
     last_git = last_start = None
     configs = {}
     handler = None
     recent_lines = collections.deque([], 200)
-    # Parse log file
+    # Parse the regions of the log file that surround each event
     f = open(logname, 'rb')
-    for line_num, line in enumerate(f):
-        line = line.rstrip()
-        line_num += 1
-        recent_lines.append((line_num, line))
-        if handler is not None:
-            ret = handler.add_line(line_num, line)
-            if ret:
-                continue
+    line_num = 0
+    for (event_type, event_line_num, event_offset,
+         context_line_num, context_offset) in index.events:
+        if event_line_num <= line_num:
+            continue
+        if handler is None and context_line_num > line_num + 1:
+            f.seek(context_offset)
+            line_num = context_line_num - 1
             recent_lines.clear()
-            handler = None
-        if line.startswith('Git version'):
-            last_git = format_comment(line_num, line)
-        elif line.startswith('Start printer at'):
-            last_start = format_comment(line_num, line)
-        elif line == '===== Config file =====':
-            handler = GatherConfig(configs, line_num, recent_lines, logname)
-            handler.add_comment(last_git)
-            handler.add_comment(last_start)
-        elif 'shutdown: ' in line or line.startswith('Dumping '):
-            handler = GatherShutdown(configs, line_num, recent_lines, logname)
-            handler.add_comment(last_git)
-            handler.add_comment(last_start)
+        while line_num < event_line_num or handler is not None:
+            line = f.readline()
+            if not line:
+                break
+            line = line.rstrip()
+            line_num += 1
+            recent_lines.append((line_num, line))
+            if handler is not None:
+                ret = handler.add_line(line_num, line)
+                if ret:
+                    continue
+                recent_lines.clear()
+                handler = None
+            if line.startswith('Git version'):
+                last_git = format_comment(line_num, line)
+            elif line.startswith('Start printer at'):
+                last_start = format_comment(line_num, line)
+            elif line == '===== Config file =====':
+                handler = GatherConfig(configs, line_num, recent_lines,
+                                       logname)
+                handler.add_comment(last_git)
+                handler.add_comment(last_start)
+            elif 'shutdown: ' in line or line.startswith('Dumping '):
+                handler = GatherShutdown(configs, line_num, recent_lines,
+                                         logname)
+                handler.add_comment(last_git)
+                handler.add_comment(last_start)
+    f.close()
     if handler is not None:
         handler.finalize()
     # Write found config files
     for cfg in configs.values():
         cfg.write_file()
 
+def main():
+    usage = "%prog [options] <logfile> [<logfile> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-j", "--jobs", type="int", dest="jobs",
+                    help="number of log files to process in parallel")
+    opts.add_option("-i", "--index-dir", type="string", dest="index_dir",
+                    help="directory to store log index files in")
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Incorrect number of arguments")
+    logindex.map_parallel(process_log, [(logname, options.index_dir)
+                                        for logname in args], options.jobs)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,122 @@
+# Index of the stats samples, config dumps, and shutdowns in a klippy.log
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, json, hashlib, collections, multiprocessing
+
+INDEX_VERSION = 1
+# Only every STATS_STRIDE Stats line is recorded in the index
+STATS_STRIDE = 64
+# Number of lines preceding an event that are needed to analyze it
+CONTEXT_LINES = 200
+
+def is_stats_line(line):
+    return line.startswith('Stats ') or line.startswith('INFO:root:Stats ')
+
+def get_event_type(line):
+    if line.startswith('Git version'):
+        return 'git'
+    if line.startswith('Start printer at'):
+        return 'start'
+    if line.startswith('===== Config file ====='):
+        return 'config'
+    if 'shutdown: ' in line or line.startswith('Dumping '):
+        return 'shutdown'
+    return None
+
+# The index stores a list of (sampletime, offset) for Stats lines and
+# a list of (type, line_num, offset, context_line_num, context_offset)
+# for the lines that logextract acts on.  Offsets are byte positions
+# that may be passed to file.seek().
+class LogIndex:
+    def __init__(self, stats, events):
+        self.stats = stats
+        self.events = events
+    def find_stats(self, sampletime):
+        # Return an offset that is at or before the first Stats line
+        # with a time of sampletime or later
+        last_offset = 0
+        for st, offset in self.stats:
+            if st >= sampletime:
+                break
+            last_offset = offset
+        return last_offset
+
+def build_index(logname):
+    stats = []
+    events = []
+    stats_count = 0
+    context = collections.deque([], CONTEXT_LINES)
+    offset = line_num = 0
+    f = open(logname, 'rb')
+    for line in f:
+        line_num += 1
+        context.append(offset)
+        if is_stats_line(line):
+            if not stats_count % STATS_STRIDE:
+                parts = line.split(None, 2)
+                try:
+                    stats.append((float(parts[1][:-1]), offset))
+                except (IndexError, ValueError):
+                    pass
+            stats_count += 1
+        else:
+            event_type = get_event_type(line)
+            if event_type is not None:
+                events.append((event_type, line_num, offset,
+                               line_num - len(context) + 1, context[0]))
+        offset += len(line)
+    f.close()
+    return LogIndex(stats, events)
+
+# The index is cached in a hidden ".<logname>.index" file next to the
+# log, or in index_dir (if given) for logs on read-only or shared
+# storage.  Names in index_dir include a hash of the log's full path so
+# that logs with the same name in different directories do not collide.
+def get_cache_name(logname, index_dir=None):
+    dirname, basename = os.path.split(logname)
+    if index_dir is None:
+        return os.path.join(dirname, ".%s.index" % (basename,))
+    path_hash = hashlib.sha1(os.path.abspath(logname)).hexdigest()[:12]
+    return os.path.join(index_dir, "%s-%s.index" % (basename, path_hash))
+
+# Load the index for a log file, using the cached copy when the log has
+# not changed since the index was created.
+def load_index(logname, index_dir=None):
+    st = os.stat(logname)
+    key = [INDEX_VERSION, st.st_size, st.st_mtime]
+    cache_name = get_cache_name(logname, index_dir)
+    try:
+        f = open(cache_name, 'rb')
+        data = json.load(f)
+        f.close()
+        if data['key'] == key:
+            return LogIndex([tuple(s) for s in data['stats']],
+                            [tuple(e) for e in data['events']])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    index = build_index(logname)
+    try:
+        f = open(cache_name, 'wb')
+        json.dump({'key': key, 'stats': index.stats, 'events': index.events},
+                  f, separators=(',', ':'))
+        f.close()
+    except (IOError, OSError):
+        # The index directory may not be writable
+        pass
+    return index
+
+# Run func(arg) for each arg in a pool of worker processes
+def map_parallel(func, args, jobs=None):
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(args))
+    if jobs <= 1:
+        return map(func, args)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(func, args)
+    finally:
+        pool.close()
+        pool.join()
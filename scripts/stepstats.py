@@ -1,40 +1,113 @@
 #!/usr/bin/env python2
-# Script to calculate stats for each stepper from a log of messages
+# Script to calculate stats for each stepper from a batch mode output file
 #
-# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+# Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+import steptiming
+
+class StepperCounts:
+    def __init__(self, oid, window_ticks):
+        self.oid = oid
+        self.window_ticks = window_ticks
+        self.dir_cmds = self.queue_cmds = 0
+        self.dir = 0
+        self.steps = [0, 0]
+        self.last_clock = 0
+        # Step counts per time window (window index -> steps)
+        self.windows = {}
+    def reset(self, clock):
+        delta = (clock - self.last_clock) & 0xffffffff
+        if delta & 0x80000000:
+            delta -= 1 << 32
+        self.last_clock += delta
+    def set_dir(self, sdir):
+        self.dir_cmds += 1
+        self.dir = sdir
+    def queue_step(self, interval, count, add):
+        self.queue_cmds += 1
+        self.steps[self.dir] += count
+        first_clock = self.last_clock + interval
+        ticks = interval*count + add*count*(count-1)//2
+        last_clock = self.last_clock + ticks
+        self.last_clock = last_clock
+        # Accumulate the whole command at once when it does not
+        # straddle a window boundary (the common case)
+        wt = self.window_ticks
+        windows = self.windows
+        first_window = first_clock // wt
+        if first_window == last_clock // wt:
+            windows[first_window] = windows.get(first_window, 0) + count
+            return
+        clock = first_clock - interval
+        for i in xrange(count):
+            clock += interval
+            interval += add
+            w = clock // wt
+            windows[w] = windows.get(w, 0) + 1
+    def get_rates(self, window_time):
+        return { w: steps / window_time for w, steps in self.windows.items() }
+
+def process(mp, filename, window_ticks):
+    steppers = {}
+    def lookup_stepper(oid):
+        so = steppers.get(oid)
+        if so is None:
+            # The dump may start after the stepper was configured
+            sys.stderr.write("Warning: stepper oid %d used before"
+                             " config_stepper\n" % (oid,))
+            so = steppers[oid] = StepperCounts(oid, window_ticks)
+        return so
+    for name, params, msglen in steptiming.iter_commands(mp, filename):
+        if name == 'queue_step':
+            lookup_stepper(params['oid']).queue_step(
+                params['interval'], params['count'], params['add'])
+        elif name == 'set_next_step_dir':
+            lookup_stepper(params['oid']).set_dir(params['dir'])
+        elif name == 'reset_step_clock':
+            lookup_stepper(params['oid']).reset(params['clock'])
+        elif name == 'config_stepper':
+            oid = params['oid']
+            steppers[oid] = StepperCounts(oid, window_ticks)
+    return steppers
 
 def main():
-    usage = "%prog [options] <comms file>"
+    usage = "%prog [options] <dictionary> <serial output>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-w", "--window", dest="window", type="float",
+                    default=1., help="step rate time window in seconds")
+    opts.add_option("-r", "--rates", action="store_true", dest="rates",
+                    help="report step rates for every time window")
     options, args = opts.parse_args()
-    if len(args) != 1:
+    if len(args) != 2:
         opts.error("Incorrect number of arguments")
-    filename = args[0]
+    dict_filename, data_filename = args
 
-    steppers = {}
-    f = open(filename, 'rb')
-    for line in f:
-        parts = line.split()
-        if not parts:
-            continue
-        args = dict([p.split('=', 1) for p in parts[1:]])
-        if parts[0] == 'config_stepper':
-            # steppers[oid] = [dir_cmds, dir, queue_cmds, pos steps, neg steps]
-            steppers[args['oid']] = [0, 0, 0, 0, 0]
-        elif parts[0] == 'set_next_step_dir':
-            so = steppers[args['oid']]
-            so[0] += 1
-            so[1] = args['dir']
-        elif parts[0] == 'queue_step':
-            so = steppers[args['oid']]
-            so[2] += 1
-            so[{'0': 3, '1': 4}[so[1]]] += int(args['count'])
-    for oid, so in sorted([(int(i[0]), i[1]) for i in steppers.items()]):
+    f = open(dict_filename, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    freq = mp.get_constant_float('CLOCK_FREQ')
+    window_ticks = max(1, int(options.window * freq))
+    window_time = window_ticks / freq
+
+    steppers = process(mp, data_filename, window_ticks)
+    for oid, so in sorted(steppers.items()):
         print "oid:%3d dir_cmds:%6d queue_cmds:%7d (%8d -%8d = %8d)" % (
-            oid, so[0], so[2], so[4], so[3], so[4]-so[3])
+            oid, so.dir_cmds, so.queue_cmds,
+            so.steps[1], so.steps[0], so.steps[1]-so.steps[0])
+        rates = so.get_rates(window_time)
+        if not rates:
+            continue
+        print "    max_rate:%10.1f steps/s avg_active_rate:%10.1f steps/s" % (
+            max(rates.values()), sum(rates.values()) / len(rates))
+        if options.rates:
+            for w, rate in sorted(rates.items()):
+                print "    %10.3f: %10.1f" % (w * window_time, rate)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python2
+# Script to analyze the accuracy and bandwidth of compressed step timing
+#
+# Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, collections, math
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto, parsedump
+
+STEP_CMDS = ['queue_step', 'set_next_step_dir', 'reset_step_clock']
+
+
+######################################################################
+# Batch output file parsing
+######################################################################
+
+# Iterate over the (msgname, params, msglen) of all commands in a
+# batch mode output file
+def iter_commands(mp, filename):
+    f = open(filename, 'rb')
+    packets = parsedump.iter_packets(mp, f)
+    for mid, params, msglen in parsedump.iter_messages(mp, packets):
+        yield mid.name, params, msglen
+    f.close()
+
+# Track the absolute clock of each step generated by step commands
+class StepClockTracker:
+    def __init__(self):
+        self.last_clock = {}
+    def reset(self, oid, clock):
+        # reset_step_clock only transmits the low 32 bits of the clock
+        last_clock = self.last_clock.get(oid, 0)
+        delta = (clock - last_clock) & 0xffffffff
+        if delta & 0x80000000:
+            delta -= 1 << 32
+        self.last_clock[oid] = last_clock + delta
+    def queue_step(self, oid, interval, count, add):
+        clock = self.last_clock.get(oid, 0)
+        out = []
+        for i in xrange(count):
+            clock += interval
+            interval += add
+            out.append(clock)
+        self.last_clock[oid] = clock
+        return out
+
+# Iterate over the (oid, step_clocks, cmd_name, cmd_len) of each step
+# related command in a batch mode output file
+def iter_steps(mp, filename):
+    tracker = StepClockTracker()
+    for name, params, msglen in iter_commands(mp, filename):
+        if name == 'queue_step':
+            oid = params['oid']
+            clocks = tracker.queue_step(
+                oid, params['interval'], params['count'], params['add'])
+            yield oid, clocks, name, msglen
+        elif name == 'reset_step_clock':
+            oid = params['oid']
+            tracker.reset(oid, params['clock'])
+            yield oid, (), name, msglen
+        elif name == 'set_next_step_dir':
+            yield params['oid'], (), name, msglen
+
+
+######################################################################
+# Statistics gathering
+######################################################################
+
+class StepperStats:
+    def __init__(self, oid):
+        self.oid = oid
+        self.steps = 0
+        self.cmd_counts = { name: 0 for name in STEP_CMDS }
+        self.cmd_bytes = 0
+        self.first_clock = self.last_clock = None
+        self.ref_cmds = self.ref_bytes = 0
+        # Error histogram (error in mcu clock ticks -> count)
+        self.errors = collections.defaultdict(int)
+        self.unmatched = 0
+    def note_command(self, clocks, name, msglen):
+        self.cmd_counts[name] += 1
+        self.cmd_bytes += msglen
+        if clocks:
+            self.steps += len(clocks)
+            if self.first_clock is None:
+                self.first_clock = clocks[0]
+            self.last_clock = clocks[-1]
+    def note_errors(self, clocks, ref_clocks):
+        errors = self.errors
+        for clock, ref_clock in zip(clocks, ref_clocks):
+            errors[ref_clock - clock] += 1
+    def get_duration(self, freq):
+        if self.first_clock is None:
+            return 0.
+        return (self.last_clock - self.first_clock) / freq
+    def error_summary(self, freq):
+        total = sum(self.errors.values())
+        if not total:
+            return None
+        ssum = sqsum = 0.
+        for err, count in self.errors.items():
+            ssum += err * count
+            sqsum += err * err * count
+        avg = ssum / total
+        stddev = math.sqrt(max(0., sqsum / total - avg * avg))
+        pcts = {}
+        want = [(0.50, 'p50'), (0.99, 'p99'), (0.999, 'p999')]
+        seen = 0
+        for err in sorted(self.errors):
+            seen += self.errors[err]
+            while want and seen >= want[0][0] * total:
+                pcts[want.pop(0)[1]] = err
+        usec = 1000000. / freq
+        return {
+            'count': total, 'avg': avg * usec, 'stddev': stddev * usec,
+            'min': min(self.errors) * usec, 'max': max(self.errors) * usec,
+            'p50': pcts['p50'] * usec, 'p99': pcts['p99'] * usec,
+            'p999': pcts['p999'] * usec }
+
+# Process a batch output file and an optional reference output file
+# (generated with max_stepper_error=0) in lockstep.  Reference step
+# clocks are buffered per stepper only until the primary stream
+# consumes them.
+class StepTimingAnalyzer:
+    def __init__(self, mp, filename, ref_filename=None):
+        self.mp = mp
+        self.filename = filename
+        self.ref_filename = ref_filename
+        self.steppers = {}
+        self.ref_pending = collections.defaultdict(collections.deque)
+        self.ref_iter = None
+        self.max_pending = 0
+    def get_stepper(self, oid):
+        ss = self.steppers.get(oid)
+        if ss is None:
+            ss = self.steppers[oid] = StepperStats(oid)
+        return ss
+    def _read_ref(self):
+        try:
+            oid, clocks, name, msglen = next(self.ref_iter)
+        except StopIteration:
+            return False
+        ss = self.get_stepper(oid)
+        if name == 'queue_step':
+            ss.ref_cmds += 1
+        ss.ref_bytes += msglen
+        pending = self.ref_pending[oid]
+        pending.extend(clocks)
+        self.max_pending = max(self.max_pending, len(pending))
+        return True
+    def _pull_ref(self, oid, count):
+        pending = self.ref_pending[oid]
+        while len(pending) < count:
+            if not self._read_ref():
+                break
+        return [pending.popleft() for i in range(min(count, len(pending)))]
+    def run(self):
+        if self.ref_filename is not None:
+            self.ref_iter = iter_steps(self.mp, self.ref_filename)
+        for oid, clocks, name, msglen in iter_steps(self.mp, self.filename):
+            ss = self.get_stepper(oid)
+            ss.note_command(clocks, name, msglen)
+            if self.ref_iter is None or not clocks:
+                continue
+            ref_clocks = self._pull_ref(oid, len(clocks))
+            ss.note_errors(clocks, ref_clocks)
+            ss.unmatched += len(clocks) - len(ref_clocks)
+        if self.ref_iter is not None:
+            # Account for any remaining reference steps
+            while self._read_ref():
+                pass
+            for oid, pending in self.ref_pending.items():
+                self.get_stepper(oid).unmatched += len(pending)
+
+
+######################################################################
+# Reporting
+######################################################################
+
+def report(analyzer, freq):
+    total_steps = total_bytes = total_ref_bytes = 0
+    duration = 0.
+    for oid in sorted(analyzer.steppers):
+        ss = analyzer.steppers[oid]
+        total_steps += ss.steps
+        total_bytes += ss.cmd_bytes
+        total_ref_bytes += ss.ref_bytes
+        duration = max(duration, ss.get_duration(freq))
+        queue_cmds = ss.cmd_counts['queue_step']
+        sduration = ss.get_duration(freq)
+        print "oid:%3d steps:%9d queue_step:%8d dir:%6d reset:%4d" % (
+            oid, ss.steps, queue_cmds, ss.cmd_counts['set_next_step_dir'],
+            ss.cmd_counts['reset_step_clock'])
+        bandwidth = 0.
+        if sduration:
+            bandwidth = ss.cmd_bytes / sduration
+        print "    bytes:%10d bandwidth:%10.1f bytes/s duration:%.3fs" % (
+            ss.cmd_bytes, bandwidth, sduration)
+        if queue_cmds and ss.steps:
+            print ("    steps/queue_step:%8.2f bytes/step:%7.4f" % (
+                float(ss.steps) / queue_cmds, float(ss.cmd_bytes) / ss.steps))
+        if analyzer.ref_iter is None:
+            continue
+        if ss.cmd_bytes:
+            print "    reference bytes:%10d compression ratio:%8.3f" % (
+                ss.ref_bytes, float(ss.ref_bytes) / ss.cmd_bytes)
+        es = ss.error_summary(freq)
+        if es is not None:
+            print ("    error(us) avg:%.3f stddev:%.3f min:%.3f max:%.3f"
+                   " p50:%.3f p99:%.3f p99.9:%.3f" % (
+                       es['avg'], es['stddev'], es['min'], es['max'],
+                       es['p50'], es['p99'], es['p999']))
+        if ss.unmatched:
+            print "    WARNING: %d steps did not match reference" % (
+                ss.unmatched,)
+    print "total steps:%d bytes:%d" % (total_steps, total_bytes)
+    if duration:
+        print "total bandwidth:%.1f bytes/s over %.3fs" % (
+            total_bytes / duration, duration)
+    if analyzer.ref_iter is not None and total_bytes:
+        print "total compression ratio:%.3f (max buffered steps %d)" % (
+            float(total_ref_bytes) / total_bytes, analyzer.max_pending)
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <dictionary> <serial output> [<reference output>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-f", "--freq", dest="freq", type="float",
+                    help="mcu clock frequency (default from dictionary)")
+    options, args = opts.parse_args()
+    if len(args) not in (2, 3):
+        opts.error("Incorrect number of arguments")
+    dict_filename, data_filename = args[:2]
+    ref_filename = None
+    if len(args) == 3:
+        ref_filename = args[2]
+
+    f = open(dict_filename, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    freq = options.freq
+    if freq is None:
+        freq = mp.get_constant_float('CLOCK_FREQ')
+
+    analyzer = StepTimingAnalyzer(mp, data_filename, ref_filename)
+    analyzer.run()
+    report(analyzer, freq)
+
+if __name__ == '__main__':
+    main()